@@ -0,0 +1,63 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import sys
+from io import BytesIO
+from zipfile import ZipFile
+
+import pytest
+
+from webapp.archive import ArchiveException, command_chunks, file_chunks, stream_zip
+
+
+def test01a():
+	""" stream a zip archive from bytes and chunks """
+	big_content = [bytes([i % 256]) * 100000 for i in range(20)]
+	archive = b"".join(stream_zip((
+		("a.txt", b"hello"),
+		("dir/b.bin", iter(big_content)),
+	)))
+	with ZipFile(BytesIO(archive)) as zipobj:
+		assert zipobj.namelist() == ["a.txt", "dir/b.bin"]
+		assert zipobj.read("a.txt") == b"hello"
+		assert zipobj.read("dir/b.bin") == b"".join(big_content)
+		assert zipobj.testzip() is None
+
+
+def test01b():
+	""" the archive is yielded while its entries are produced """
+	produced = []
+
+	def content():
+		for i in range(3):
+			produced.append(i)
+			yield bytes(range(256)) * 1000 * (i + 1)
+
+	chunks = stream_zip((("a.bin", content()), ))
+	next(chunks)
+	assert len(produced) < 3
+
+
+def test02a(tmp_path):
+	""" read a file by chunks """
+	filepath = tmp_path / "file.bin"
+	filepath.write_bytes(b"x" * 10)
+	assert list(file_chunks(str(filepath), chunk_size=4)) == [b"xxxx", b"xxxx", b"xx"]
+
+
+def test03a():
+	""" stream the output of a command """
+	assert b"".join(command_chunks([sys.executable, "-c", "print('hello')"])) == b"hello\n"
+
+
+def test03b():
+	""" a failing command raises an exception """
+	with pytest.raises(ArchiveException):
+		b"".join(command_chunks([sys.executable, "-c", "import sys; print('partial'); sys.exit(3)"]))
+
+
+def test03c():
+	""" a command writing a lot on its standard error does not block """
+	script = "import sys; sys.stderr.write('w' * 1000000); sys.stderr.flush(); print('done')"
+	assert b"".join(command_chunks([sys.executable, "-c", script])) == b"done\n"
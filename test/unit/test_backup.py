@@ -0,0 +1,159 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import json
+import sys
+from io import BytesIO
+from unittest.mock import Mock
+from zipfile import ZipFile
+
+import pytest
+import time_machine
+
+import webapp.backup
+from webapp.archive import stream_zip
+from webapp.backup import (
+	BackupException, _run_restore, backup_db, find_database_dump, read_manifest, restore_backups, restore_servicing_files
+)
+
+
+@pytest.fixture(scope='function')
+def servicings(tmp_path, monkeypatch):
+	home = tmp_path / "home"
+	home.mkdir()
+	monkeypatch.setenv('HOME', str(home))
+	monkeypatch.setattr(webapp.backup, 'CONFIG_FILEPATH', str(home / "config.ini"))
+	(home / "config.ini").write_text("[qrcode]\n")
+	monkeypatch.setattr(webapp.backup, 'command_chunks', Mock(side_effect=lambda args: iter((b"dump", ))))
+	files = {}
+	monkeypatch.setattr(webapp.backup, 'get_servicing_files', lambda: tuple(files.items()))
+
+	def add(hashed_filename, exported_filename, content):
+		(home / hashed_filename).write_bytes(content)
+		files[hashed_filename] = exported_filename
+
+	return add
+
+
+def backup(tmp_path, name, incremental):
+	archive = tmp_path / name
+	entries, record_manifest = backup_db("jellyfish", incremental=incremental, backup_dir=str(tmp_path / "backups"))
+	archive.write_bytes(b"".join(stream_zip(entries)))
+	record_manifest()
+	return str(archive)
+
+
+def test01a(tmp_path, servicings):
+	""" An incremental backup only holds the servicing files which changed """
+	servicings("a1", "Bcd_1.pdf", b"report 1")
+	servicings("a2", "Bcd_2.pdf", b"report 2")
+	with time_machine.travel("2024-01-01 10:00"):
+		full = backup(tmp_path, "full.zip", incremental=False)
+	servicings("a3", "Bcd_3.pdf", b"report 3")
+	with time_machine.travel("2024-01-02 10:00"):
+		incremental = backup(tmp_path, "incremental.zip", incremental=True)
+	with ZipFile(full) as zipobj:
+		assert sorted(name for name in zipobj.namelist() if name.startswith("servicings/")) == ["servicings/Bcd_1.pdf", "servicings/Bcd_2.pdf"]
+		assert "jellyfish.dump" in zipobj.namelist()
+	with ZipFile(incremental) as zipobj:
+		assert [name for name in zipobj.namelist() if name.startswith("servicings/")] == ["servicings/Bcd_3.pdf"]
+		assert not [name for name in zipobj.namelist() if name.startswith("csv/")]
+
+
+def test01b(tmp_path, servicings):
+	""" Restore the servicing files of a chain of backups """
+	servicings("a1", "Bcd_1.pdf", b"report 1")
+	servicings("a2", "Bcd_2.pdf", b"report 2")
+	with time_machine.travel("2024-01-01 10:00"):
+		full = backup(tmp_path, "full.zip", incremental=False)
+	servicings("a2", "Bcd_2.pdf", b"report 2 fixed")
+	with time_machine.travel("2024-01-02 10:00"):
+		incremental1 = backup(tmp_path, "incremental1.zip", incremental=True)
+	servicings("a3", "Bcd_3.pdf", b"report 3")
+	with time_machine.travel("2024-01-03 10:00"):
+		incremental2 = backup(tmp_path, "incremental2.zip", incremental=True)
+
+	dest_dir = tmp_path / "restored"
+	dest_dir.mkdir()
+	restore_servicing_files((full, incremental1, incremental2), str(dest_dir))
+	assert (dest_dir / "a1").read_bytes() == b"report 1"
+	assert (dest_dir / "a2").read_bytes() == b"report 2 fixed"
+	assert (dest_dir / "a3").read_bytes() == b"report 3"
+
+	with pytest.raises(BackupException):
+		restore_servicing_files((full, incremental2), str(dest_dir))
+	with pytest.raises(BackupException):
+		restore_servicing_files((incremental1, incremental2), str(dest_dir))
+
+
+def test01c(tmp_path, servicings):
+	""" An aborted backup is not the base of the next incremental backup """
+	servicings("a1", "Bcd_1.pdf", b"report 1")
+	with time_machine.travel("2024-01-01 10:00"):
+		backup(tmp_path, "full.zip", incremental=False)
+	servicings("a2", "Bcd_2.pdf", b"report 2")
+	with time_machine.travel("2024-01-02 10:00"):
+		entries, record_manifest = backup_db("jellyfish", incremental=True, backup_dir=str(tmp_path / "backups"))
+		next(stream_zip(entries))
+		record_manifest()
+	with time_machine.travel("2024-01-03 10:00"):
+		incremental = backup(tmp_path, "incremental.zip", incremental=True)
+	with ZipFile(incremental) as zipobj:
+		assert [name for name in zipobj.namelist() if name.startswith("servicings/")] == ["servicings/Bcd_2.pdf"]
+		assert read_manifest(zipobj)['base'] == "2024-01-01T10-00-00"
+
+
+def test01d(tmp_path, servicings):
+	""" A servicing file name leading out of the restore directory is refused """
+	servicings("a1", "Bcd_1.pdf", b"report 1")
+	full = backup(tmp_path, "full.zip", incremental=False)
+	with ZipFile(full) as zipobj:
+		entries = {name: zipobj.read(name) for name in zipobj.namelist()}
+	manifest = json.loads(entries["manifest.json"])
+	manifest['servicings'] = {"../a1": manifest['servicings']["a1"]}
+	entries["manifest.json"] = json.dumps(manifest).encode()
+	forged = tmp_path / "forged.zip"
+	forged.write_bytes(b"".join(stream_zip(entries.items())))
+	dest_dir = tmp_path / "restored"
+	dest_dir.mkdir()
+	with pytest.raises(BackupException):
+		restore_servicing_files((str(forged), ), str(dest_dir))
+	assert not (tmp_path / "a1").exists()
+
+
+def test01e(tmp_path, servicings, monkeypatch):
+	""" Restore a chain of backups given in any order: the reports of the chain and the database of the latest """
+	monkeypatch.setattr(webapp.backup, 'restore_db', Mock())
+	servicings("a1", "Bcd_1.pdf", b"report 1")
+	with time_machine.travel("2024-01-01 10:00"):
+		full = backup(tmp_path, "full.zip", incremental=False)
+	servicings("a2", "Bcd_2.pdf", b"report 2")
+	with time_machine.travel("2024-01-02 10:00"):
+		incremental = backup(tmp_path, "incremental.zip", incremental=True)
+	(tmp_path / "home" / "a1").unlink()
+	(tmp_path / "home" / "a2").unlink()
+	restore_backups((incremental, full))
+	assert (tmp_path / "home" / "a1").read_bytes() == b"report 1"
+	assert (tmp_path / "home" / "a2").read_bytes() == b"report 2"
+	assert webapp.backup.restore_db.call_args[0][0].filename == incremental
+
+
+def test02a(tmp_path, servicings):
+	""" Find the database dump of the legacy and of the current backups """
+	with ZipFile(backup(tmp_path, "full.zip", incremental=False)) as zipobj:
+		assert find_database_dump(zipobj) == "jellyfish.dump"
+	legacy = tmp_path / "legacy.zip"
+	with ZipFile(str(legacy), 'w') as zipobj:
+		zipobj.writestr("config.ini", "")
+		zipobj.writestr("jellyfish.sql", "SELECT 1;")
+	with ZipFile(str(legacy)) as zipobj:
+		assert find_database_dump(zipobj) == "jellyfish.sql"
+
+
+def test02b():
+	""" The dump is streamed to the restore command whose exit status is returned """
+	dump = BytesIO(b"x" * 300000)
+	assert _run_restore([sys.executable, "-c", "import sys; sys.exit(len(sys.stdin.buffer.read()) != 300000)"], dump, 300000) == 0
+	dump = BytesIO(b"x" * 300000)
+	assert _run_restore([sys.executable, "-c", "import sys; sys.exit(3)"], dump, 300000) == 3
@@ -0,0 +1,49 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+from flask import Flask
+
+from webapp.cache import ProcessCache, RequestCache, get_process_caches_stats
+
+
+def test01a():
+	""" Values are loaded once until the cache is invalidated """
+	cache = ProcessCache("test01a")
+	loaded = []
+	loader = lambda: loaded.append(1) or len(loaded)
+	assert cache.get("a", loader) == 1
+	assert cache.get("a", loader) == 1
+	cache.invalidate("a")
+	assert cache.get("a", loader) == 2
+	assert cache.stats == {'size': 1, 'hits': 1, 'misses': 2}
+	assert get_process_caches_stats()["test01a"] == cache.stats
+
+
+def test01b():
+	""" A value loaded while the cache is invalidated is not kept """
+	cache = ProcessCache("test01b")
+
+	def loader():
+		cache.invalidate()
+		return 1
+
+	assert cache.get("a", loader) == 1
+	assert cache.stats['size'] == 0
+
+
+def test02a():
+	""" Values are kept for the duration of a request only """
+	cache = RequestCache("test02a")
+	loaded = []
+	loader = lambda: loaded.append(1) or len(loaded)
+	app = Flask(__name__)
+	with app.test_request_context():
+		assert cache.get("a", loader) == 1
+		assert cache.get("a", loader) == 1
+	with app.test_request_context():
+		assert cache.get("a", loader) == 2
+		cache.invalidate()
+		assert cache.get("a", loader) == 3
+	assert cache.get("a", loader) == 4
+	assert cache.get("a", loader) == 5
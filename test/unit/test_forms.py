@@ -0,0 +1,25 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+from io import StringIO
+
+import pytest
+
+from webapp.forms import read_members_csv
+
+
+def test01a():
+	""" Read the members of a CSV file """
+	fobj = StringIO("last_name,first_name,license_nb\nWaters, Roger ,1234\n\nGilmour,David,\n")
+	assert list(read_members_csv(fobj)) == [
+		{'last_name': "Waters", 'first_name': "Roger", 'license_nb': "1234"},
+		{'last_name': "Gilmour", 'first_name': "David", 'license_nb': ""},
+	]
+
+
+def test01b():
+	""" A line without all the fields is reported with its number """
+	fobj = StringIO("last_name,first_name,license_nb\nWaters,Roger,1234\nGilmour,David\n")
+	with pytest.raises(ValueError, match="line 3"):
+		list(read_members_csv(fobj))
@@ -2,6 +2,9 @@
 # Copyright 2021-2026, Johann Saunier
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+from time import perf_counter
+
+import webapp
 from webapp.views.loan import get_scanned_code_content
 
 CONFIG_QRCODE = {
@@ -31,3 +34,19 @@ def test02a():
 	assert get_scanned_code_content("https://l.ffessm.fr/c.asp?id=1234567_85648D") == {
 		'license_nb': "1234567",
 	}
+
+
+def test03a():
+	""" Decode 10k scans with the configuration """
+	texts = [
+		webapp.CONFIG_QRCODE['item'] % ("%s%d" % (prefix, i))
+		for i in range(2500)
+		for prefix in list(webapp.CONFIG_REF_PREFIXES.values())[:3]
+	] + [webapp.CONFIG_QRCODE['license'] % i for i in range(2500)]
+	start = perf_counter()
+	decoded = [get_scanned_code_content(text) for text in texts]
+	duration = perf_counter() - start
+	assert len(decoded) == 10000
+	assert all(decoded)
+	# a generous bound, only meant to catch a decoder rebuilt for every scan
+	assert duration < 10
@@ -2,11 +2,20 @@
 # Copyright 2021-2026, Johann Saunier
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
+from concurrent.futures import ProcessPoolExecutor
+from os import listdir, utime
+from os.path import join
 from unittest.mock import Mock
+from xml.dom.minidom import parseString
 
 import pytest
+from PIL import Image
 
-from webapp.qrcode_gen import ConverterException, Page, PageFullException, Point
+import webapp.qrcode_gen
+from webapp.qrcode_gen import (
+	ConverterException, Page, PageFullException, Point, QRCode, TileCache, VectorPage, VectorQRCode, fill_pages,
+	render_qr_code_images
+)
 
 
 def test01a():
@@ -100,3 +109,95 @@ def test04b():
 	page.add_image(mock_image1)
 	with pytest.raises(ConverterException):
 		page.add_image(mock_image2)
+
+
+def test05a():
+	""" pages are yielded as soon as they are full """
+	mock_image_factory = Mock()
+	mock_image_factory.new = Mock(side_effect=lambda *args: Mock())
+	mock_image = Mock(width=410, height=410)
+	pages = fill_pages((mock_image for i in range(80)), lambda: Page(image_factory=mock_image_factory))
+	first_page = next(pages)
+	assert first_page._page.paste.call_count == 35
+	assert [page._page.paste.call_count for page in pages] == [35, 10]
+
+
+def test05b():
+	""" an empty page is yielded when there is no image """
+	mock_image_factory = Mock()
+	pages = list(fill_pages((), lambda: Page(image_factory=mock_image_factory)))
+	assert len(pages) == 1
+
+
+def test06a(tmp_path):
+	""" the tiles cache key covers the data, the text and the QR code configuration """
+	key = TileCache.key("https://gear.jellyfish.org/S1", "S1")
+	assert key == TileCache.key("https://gear.jellyfish.org/S1", "S1")
+	assert key != TileCache.key("https://gear.jellyfish.org/S1", "S2")
+	assert key != TileCache.key("https://gear.jellyfish.org/S2", "S1")
+	assert key != TileCache.key("https://gear.jellyfish.org/S1", "S1", dpi=600)
+	assert key != TileCache.key("https://gear.jellyfish.org/S1", "S1", qrcode={'version': 6, 'size': 28, 'padding': 3.5, 'border_width': 0.3, 'margin': 5})
+
+
+def test06b(tmp_path):
+	""" store and load a tile """
+	cache = TileCache(str(tmp_path))
+	assert "a" not in cache
+	assert cache.get("a") is None
+	img = Image.new("RGB", (20, 10), (255, 0, 0))
+	cache.put("a", img)
+	assert "a" in cache
+	assert cache.get("a").tobytes() == img.tobytes()
+
+
+def test06c(tmp_path):
+	""" the least recently used tiles are evicted """
+	img = Image.new("RGB", (20, 10), (255, 0, 0))
+	cache = TileCache(str(tmp_path))
+	for i, key in enumerate("abcd"):
+		cache.put(key, img)
+		utime(join(str(tmp_path), "%s.png" % key), (i, i))
+	assert "a" in cache
+	tile_size = (tmp_path / "b.png").stat().st_size
+	TileCache(str(tmp_path), max_bytes=2 * tile_size).evict()
+	assert sorted(listdir(str(tmp_path))) == ["a.png", "d.png"]
+
+
+def test07a():
+	""" vector QR codes are sized in millimeters whatever the dpi """
+	qr_code = VectorQRCode().create_qr_code_image("https://gear.jellyfish.org/S1", "S1")
+	assert qr_code.width == qr_code.height == 28 + 2 * (3.5 + 0.3 + 5)
+	assert VectorQRCode(dpi=1200).create_qr_code_image("https://gear.jellyfish.org/S1", "S1") == qr_code
+
+
+def test07b():
+	""" vector pages are filled like the bitmap ones """
+	qr_code = VectorQRCode().create_qr_code_image("https://gear.jellyfish.org/S1", "<S&1>")
+	pages = list(fill_pages((qr_code for i in range(30)), VectorPage))
+	assert len(pages) == 2
+	document = parseString(pages[0].to_svg())
+	assert len(document.getElementsByTagName("text")) == 24
+	assert document.getElementsByTagName("text")[0].firstChild.data == "<S&1>"
+	assert document.documentElement.getAttribute("width") == "210mm"
+	assert len(parseString(pages[1].to_svg()).getElementsByTagName("text")) == 6
+
+
+def test08a(monkeypatch):
+	""" the QR codes rendered by a pool of workers are the same and in the same order, a few at a time """
+	submitted = []
+
+	class CountingExecutor(ProcessPoolExecutor):
+		def submit(self, *args, **kwargs):
+			submitted.append(args)
+			return super().submit(*args, **kwargs)
+
+	monkeypatch.setattr(webapp.qrcode_gen, 'ProcessPoolExecutor', CountingExecutor)
+	monkeypatch.setattr(webapp.qrcode_gen, 'RENDERS_IN_FLIGHT_PER_WORKER', 1)
+	data_pairs = [("https://gear.jellyfish.org/M%d" % i, "M%d" % i) for i in range(7)]
+	images = render_qr_code_images(data_pairs, workers=2)
+	first_image = next(images)
+	assert len(submitted) == 3
+	renderer = QRCode()
+	expected = [renderer.create_qr_code_image(data, text) for data, text in data_pairs]
+	assert first_image.tobytes() == expected[0].tobytes()
+	assert [img.tobytes() for img in images] == [img.tobytes() for img in expected[1:]]
@@ -5,9 +5,11 @@
 import datetime as dt
 import logging
 from datetime import date, datetime, timedelta
-from logging import INFO
+from logging import DEBUG, INFO
 from os import environ
+from time import sleep
 
+import psycopg2
 import pytest
 import time_machine
 from flask import Flask
@@ -16,24 +18,38 @@ from weblib.models import WEBLIB_MODELS, User, flask_db
 from weblib.requests import create_user, get_user, get_users
 from weblib.table import Table
 
+from webapp.cache import InvalidationListener, ProcessCache
 from webapp.items import ITEM_TYPE_BCD, ITEM_TYPE_FIRST_STAGE, ITEM_TYPE_SECOND_STAGE, ITEM_TYPE_SUIT, ITEM_USAGE_MAX
 from webapp.models import (
-	ITEM_FASTENING_DIN, ITEM_FASTENING_YOKE, ITEM_GENDER_MALE, MODELS, Borrow, IsComposedOf, Item, ItemState, Member
+	ITEM_FASTENING_DIN, ITEM_FASTENING_YOKE, ITEM_GENDER_MALE, MODELS, Borrow, Inventory, IsComposedOf, Item, ItemState,
+	Member
 )
 from webapp.requests import (
-	InventoryException, borrow_item, create_inventory, create_item, create_item_state, create_servicing,
-	get_borrowed_items, get_current_inventory_remaining_items, get_inventory_items_select_list, get_item, get_item_id,
-	get_item_references, get_item_states_dates, get_item_type, get_items, get_items_estimations,
-	get_items_estimations_table, get_items_in_servicing, get_items_last_state, get_items_to_service,
-	get_latest_inventory_date, get_loans, get_member, get_member_id, get_members_fullnames, get_regulators,
-	get_running_inventory_date, get_servicing_files, get_type_and_id, give_back_item, is_item_borrowed, service,
-	stop_inventory_campaign, trash_item, untrash_item
+	DatabaseException, ITEMS_CACHE, InventoryException, borrow_item, borrow_items, carry_forward_states,
+	create_inventory, create_item, create_item_state, create_items_states, create_servicing,
+	get_available_item_references, get_borrowed_items, get_current_inventory_remaining_items,
+	get_inventory_items_select_list, get_inventory_missing_items, get_inventory_progress, get_inventory_unusable_items,
+	get_item, get_item_id, get_item_reference, get_item_references, get_item_states_dates, get_item_type, get_items,
+	get_items_estimations, get_items_estimations_table, get_items_in_servicing, get_items_last_state, get_items_names,
+	get_items_to_service, get_latest_inventory_date, get_loans, get_member, get_member_id, get_members_fullnames,
+	get_part_parent, get_regulator_composition, get_regulators, get_running_inventory_date, get_servicing_files,
+	get_type_and_id, get_uninventoried_items, give_back_item, invalidate_inventory_campaign, invalidate_items,
+	is_item_borrowed, refresh_item_states, refresh_items_current_state, restart_inventory_campaign, service,
+	stop_inventory_campaign, sync_members, trash_item, untrash_item, update_item
 )
 
 for module in ("peewee", "passlib"):
 	logging.getLogger(module).setLevel(INFO)
 
 
+def count_queries(caplog, func, *args, **kwargs):
+	""" Number of SQL queries sent to the database while executing func(*args, **kwargs) """
+	caplog.clear()
+	with caplog.at_level(DEBUG, logger="peewee"):
+		func(*args, **kwargs)
+	return len([record for record in caplog.records if record.name == "peewee"])
+
+
 @pytest.fixture(scope='function')
 def populate_db():
 	app = Flask(__name__)
@@ -47,6 +63,8 @@ def populate_db():
 	}
 
 	flask_db.init_app(app)
+	invalidate_items()
+	invalidate_inventory_campaign()
 
 	for model in WEBLIB_MODELS + MODELS:
 		model.drop_table(safe=True, cascade=True)
@@ -140,11 +158,11 @@ def test00b(populate_db):
 
 def test00c(populate_db):
 	""" Get all BCDs when at least one inventory exists"""
-	ItemState.create(item_id=1, date="2019-09-09", is_present=False, is_usable=True)
+	create_item_state(item_id=1, date="2019-09-09", is_present=False, is_usable=True)
 	create_inventory(date=date(2020, 9, 9))
-	ItemState.create(item_id=2, date="2020-09-09", is_present=True, is_usable=True)
-	ItemState.create(item_id=3, date="2020-09-09", is_present=False, is_usable=True)
-	ItemState.create(item_id=4, date="2020-09-09", is_present=True, is_usable=False)
+	create_item_state(item_id=2, date="2020-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2020-09-09", is_present=False, is_usable=True)
+	create_item_state(item_id=4, date="2020-09-09", is_present=True, is_usable=False)
 	create_item(type=ITEM_TYPE_BCD, reference=33, serial_nb="s33", owner_club="Club")
 
 	table = Table("items").build_from_request(get_items(ITEM_TYPE_BCD))
@@ -171,10 +189,10 @@ def test00c(populate_db):
 
 def test00d(populate_db):
 	""" Get all usable BCDs when no inventory exists"""
-	ItemState.create(item_id=1, date="2019-09-09", is_present=False, is_usable=True)
-	ItemState.create(item_id=2, date="2020-09-09", is_present=True, is_usable=True)
-	ItemState.create(item_id=3, date="2020-09-09", is_present=False, is_usable=True)
-	ItemState.create(item_id=4, date="2020-09-09", is_present=True, is_usable=False)
+	create_item_state(item_id=1, date="2019-09-09", is_present=False, is_usable=True)
+	create_item_state(item_id=2, date="2020-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2020-09-09", is_present=False, is_usable=True)
+	create_item_state(item_id=4, date="2020-09-09", is_present=True, is_usable=False)
 	create_item(type=ITEM_TYPE_BCD, reference=33, serial_nb="s33", owner_club="Club")
 
 	def class_builder(fields_dict):
@@ -202,6 +220,25 @@ def test00d(populate_db):
 	)
 
 
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test00e(populate_db):
+	""" Get all BCDs, states are not recorded chronologically and some BCDs have been serviced """
+	create_item_state(item_id=1, date="2022-09-09", is_present=False, is_usable=True)
+	create_item_state(item_id=1, date="2021-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=2, date="2021-09-09", is_present=True, is_usable=False)
+	create_item_state(item_id=2, date="2022-09-09", is_present=True, is_usable=True)
+	create_servicing(item_id=3, date=date(2022, 10, 9), report_file="185b42f.pdf")
+	create_servicing(item_id=4, date=date(2021, 10, 9), report_file="185b42g.pdf")
+
+	table = Table("items").build_from_request(get_items(ITEM_TYPE_BCD))
+	assert [row['fields'][-3:] for row in table.dict['rows']] == [
+		("No", "Yes", "No"),
+		("Yes", "Yes", "No"),
+		("Yes", "Yes", "Yes"),
+		("Yes", "Yes", "No"),
+	]
+
+
 def test00j(populate_db):
 	""" Get characteristics of an item by id """
 	assert get_item(3) == {
@@ -262,6 +299,75 @@ def test01e(populate_db):
 	)
 
 
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test01f(populate_db):
+	""" The cached references of the available items are the same as the computed ones after each event """
+	def assert_parity():
+		for item_type in (ITEM_TYPE_BCD, ITEM_TYPE_FIRST_STAGE, ITEM_TYPE_SUIT):
+			assert get_available_item_references(item_type) == get_item_references(item_type, available_items_only=True)
+
+	assert_parity()
+	assert get_available_item_references(ITEM_TYPE_BCD) == ((1, 1), (2, 2), (3, 3), (4, 10))
+	borrow_item(2, 1, 1, datetime(2021, 9, 15), 1)
+	assert_parity()
+	give_back_item(2, datetime(2021, 9, 16))
+	assert_parity()
+	create_item_state(item_id=1, is_present=False, is_usable=True, date=datetime.now())
+	assert_parity()
+	service((3, ))
+	assert_parity()
+	trash_item(4)
+	assert_parity()
+	untrash_item(4)
+	assert_parity()
+
+
+def test01g(populate_db, caplog):
+	""" The items and members are looked up once per request until they are modified """
+	def lookups():
+		get_item_type(1)
+		get_item(1)
+		get_item_reference("1")
+		get_member(1)
+		get_member("1")
+
+	with Flask(__name__).test_request_context():
+		assert count_queries(caplog, lookups) == 2
+		assert count_queries(caplog, lookups) == 0
+		trash_item(1)
+		assert get_item(1) == {}
+	assert count_queries(caplog, lookups) == 2
+
+
+def test01h(populate_db, caplog):
+	""" The items are served from the process cache until they are modified """
+	get_item_type(4)
+	get_item_id(ITEM_TYPE_BCD, 10)
+	hits = ITEMS_CACHE.hits
+	assert count_queries(caplog, get_item_type, 4) == 0
+	assert count_queries(caplog, get_item_id, ITEM_TYPE_BCD, "10") == 0
+	assert ITEMS_CACHE.hits == hits + 2
+	trash_item(4)
+	assert get_item_id(ITEM_TYPE_BCD, 10) is None
+	assert get_item(4) == {}
+
+
+def test01i(populate_db):
+	""" The caches are invalidated when another process notifies a modification """
+	cache = ProcessCache("test01i")
+	listener = InvalidationListener("jellyfish_test", (cache, ))
+	database = flask_db.database
+	listener.start(lambda: psycopg2.connect(dbname=database.database, **database.connect_params))
+	assert listener.is_listening
+	for _ in range(50):
+		cache.get("a", lambda: 1)
+		database.execute_sql("SELECT pg_notify('jellyfish_test', '0')")
+		sleep(0.1)
+		if cache.stats['size'] == 0:
+			break
+	assert cache.stats['size'] == 0
+
+
 def test01z(populate_db):
 	""" Get all the references for composite items """
 	assert get_item_references(ITEM_TYPE_FIRST_STAGE) == (
@@ -344,6 +450,38 @@ def test03c(populate_db):
 	)
 
 
+def test03e(populate_db):
+	""" Get the composition of a regulator and the parent of a part at a given date """
+	first_stage = Item.create(type="first_stage", reference=2, owner_club="Club", brand="Aqualung", model="Titan LX Suprème", serial_nb="701", is_cold_water=True, entry_date="01/06/07", fastening=ITEM_FASTENING_DIN)
+	IsComposedOf.create(parent=first_stage.id, child=8, at_date="02/06/07")
+	assert get_regulator_composition(5) == (6, 7)
+	assert get_regulator_composition(5, at_date=date(2007, 6, 1)) == (6, 7, 8)
+	assert get_regulator_composition(5, at_date=date(2007, 5, 31)) == ()
+	assert get_regulator_composition(first_stage.id) == (8, )
+	assert get_part_parent(8) == first_stage.id
+	assert get_part_parent(8, at_date=date(2007, 6, 1)) == 5
+	assert get_part_parent(8, at_date=date(2007, 5, 31)) is None
+	assert get_part_parent(12) is None
+	assert tuple(get_regulators(at_date=date(2007, 6, 1))['rows'][0])[-1] == (
+		("6", "Second stage", "1", "Aqualung", "Titan LX Suprème", "7056702"),
+		("7", "Octopus", "1", "Aqualung", "Titan LX Octopus", "7056703"),
+		("8", "Manometer", "1", "Aqualung", "Manometer 200 bars", "7056704"),
+	)
+
+
+def test03d(populate_db, caplog):
+	""" Get all main regulators, the number of queries does not depend on the size of the fleet """
+	queries_count = count_queries(caplog, get_regulators)
+	for reference in range(2, 42):
+		first_stage = Item.create(type="first_stage", reference=reference, owner_club="Club", serial_nb=f"fs{reference}")
+		for part_type in (ITEM_TYPE_SECOND_STAGE, "octopus", "manometer"):
+			part = Item.create(type=part_type, reference=reference + 10, owner_club="Club", serial_nb=f"{part_type}{reference}")
+			IsComposedOf.create(parent=first_stage.id, child=part.id, at_date="01/06/07")
+	assert count_queries(caplog, get_regulators) == queries_count
+	assert len(get_regulators()['rows']) == 41
+	assert all(len(row.children) == 3 for row in get_regulators()['rows'])
+
+
 def test04b(populate_db):
 	""" Get the fullnames of the members """
 	assert get_members_fullnames() ==  (
@@ -389,6 +527,73 @@ def test05b(populate_db):
 	assert Item.get(Item.id == 1).usage_counter == 10
 
 
+def test05c(populate_db):
+	""" A refused borrow does not change the usage counter """
+	borrow_item(1, 1, 2, datetime(2021, 9, 15), 7)
+	with pytest.raises(IntegrityError):
+		borrow_item(1, 1, 1, datetime(2021, 9, 15), 3)
+	assert Item.get(Item.id == 1).usage_counter == 7
+	assert Borrow.select().where(Borrow.item == 1).count() == 1
+
+
+def test05d(populate_db, caplog, monkeypatch):
+	""" Borrowing an item is done in two statements, plus one to notify the other processes when they listen """
+	assert count_queries(caplog, borrow_item, 1, 1, 2, datetime(2021, 9, 15), 7) == 2
+	monkeypatch.setattr(InvalidationListener, 'is_listening', True)
+	assert count_queries(caplog, borrow_item, 2, 1, 2, datetime(2021, 9, 15), 7) == 3
+
+
+def test05e(populate_db):
+	""" The database refuses a second open loan of the same item """
+	borrow_item(1, 1, 2, datetime(2021, 9, 15), 7)
+	assert is_item_borrowed(1)
+	assert not is_item_borrowed(2)
+	with pytest.raises(IntegrityError):
+		Borrow.create(item=1, user=1, member=1, from_datetime=datetime(2021, 9, 16))
+
+
+def test05f(populate_db):
+	""" Borrow a kit, the refused items do not cancel the others """
+	borrow_item(1, 1, 2, datetime(2021, 9, 15), 7)
+	errors = borrow_items((1, 2, 99, 3, 2), 1, 2, datetime(2021, 9, 15), 2)
+	assert isinstance(errors[0], IntegrityError)
+	assert errors[1] is None
+	assert errors[2] is not None
+	assert errors[3] is None
+	assert isinstance(errors[4], IntegrityError)
+	assert [Item.get(Item.id == item_id).usage_counter for item_id in (1, 2, 3, 4)] == [7, 2, 2, 0]
+	assert get_borrowed_items() == ((1, "Bcd 1"), (2, "Bcd 2"), (3, "Bcd 3"))
+
+
+def test05g(populate_db, caplog):
+	""" Resolve items from their ids and from their types and references in one query """
+	assert get_items_names((1, 99), ((ITEM_TYPE_BCD, 10), ("octopus", 3), ("mask", 4))) == {
+		1: (ITEM_TYPE_BCD, 1),
+		4: (ITEM_TYPE_BCD, 10),
+		12: ("octopus", 3),
+	}
+	assert get_items_names() == {}
+	assert count_queries(caplog, get_items_names, (1, 2), ((ITEM_TYPE_BCD, 10), )) == 1
+
+
+def test05h(populate_db):
+	""" A scanned unknown or trashed item has no id, lending it anyway is refused """
+	assert get_item_id(ITEM_TYPE_BCD, 999) is None
+	trash_item(1)
+	assert get_item_id(ITEM_TYPE_BCD, 1) is None
+	with pytest.raises(DatabaseException):
+		borrow_item(None, 1, 2, datetime(2021, 9, 15), 7)
+	assert Borrow.select().count() == 0
+
+def test05i(populate_db):
+	""" Modifying an item drops it from the caches """
+	assert get_item_id(ITEM_TYPE_BCD, 1) == 1
+	update_item(1, reference=101)
+	assert get_item_id(ITEM_TYPE_BCD, 1) is None
+	assert get_item_id(ITEM_TYPE_BCD, 101) == 1
+	with pytest.raises(DatabaseException):
+		update_item(99, reference=102)
+
 def test06a(populate_db):
 	""" Get borrowed items """
 	borrow_item(1, 1, 2, datetime(2021, 9, 15), 7)
@@ -504,12 +709,57 @@ def test12b(populate_db):
 	assert get_user(2).last_name == "Beck"
 
 
+def test13a(populate_db):
+	""" Synchronize members by license number, the missing ones are removed unless they borrowed an item """
+	borrow_item(1, 1, 1, datetime(2021, 9, 15), 1)
+	Member.create(last_name="Mason", first_name="Nick", license_nb=None)
+	Member.create(last_name="Wright", first_name="Rick", license_nb="C-1")
+	assert sync_members((
+		{'last_name': "Gilmour", 'first_name': "Dave", 'license_nb': "A-1234"},
+		{'last_name': "Mason", 'first_name': "Nick", 'license_nb': "M-1"},
+		{'last_name': "Waters", 'first_name': "Roger", 'license_nb': "B-2"},
+		{'last_name': "Waters", 'first_name': "Roger", 'license_nb': "B-3"},
+		{'last_name': "Barrett", 'first_name': "Syd", 'license_nb': ""},
+	)) == {'inserted': 2, 'updated': 2, 'unchanged': 0, 'removed': 1}
+	assert [(m.last_name, m.first_name, m.license_nb, m.has_guarantee) for m in Member.select().order_by(Member.id)] == [
+		("Rambo", "John", "A-5678", False),
+		("Gilmour", "Dave", "A-1234", True),
+		("Mason", "Nick", "M-1", False),
+		("Waters", "Roger", "B-2", False),
+		("Barrett", "Syd", None, False),
+	]
+	assert get_member_id("B-2") == Member.get(Member.last_name == "Waters").id
+	assert get_member_id("") is None
+
+
+def test13b(populate_db, caplog):
+	""" Synchronizing unchanged members does not write anything """
+	members = [{'last_name': m.last_name, 'first_name': m.first_name, 'license_nb': m.license_nb} for m in Member.select()]
+	assert sync_members(members) == {'inserted': 0, 'updated': 0, 'unchanged': 2, 'removed': 0}
+	assert count_queries(caplog, sync_members, members) == 1
+
+
+def test13c(populate_db):
+	""" The license numbers are unique """
+	with pytest.raises(IntegrityError):
+		Member.create(last_name="Waters", first_name="Roger", license_nb="A-1234")
+	Member.create(last_name="Waters", first_name="Roger", license_nb="")
+	Member.create(last_name="Barrett", first_name="Syd", license_nb="")
+
+
 def test14a(populate_db):
 	""" Return the type and id of an item given it's QRcode reference """
 	assert get_type_and_id("S1") == ("bcd", 1)
 	assert get_type_and_id("D1") == ("first_stage", 5)
 
 
+def test14b(populate_db):
+	""" Unknown or malformed QRcode references """
+	assert get_type_and_id("S99") is None
+	assert get_type_and_id("X1") is None
+	assert get_type_and_id("") is None
+
+
 def test15a(populate_db):
 	""" Trash an item """
 	trashed_id = get_item_id(ITEM_TYPE_FIRST_STAGE, 1)
@@ -569,6 +819,22 @@ def test20d(populate_db):
 	assert get_running_inventory_date() == dt.date(2023, 2, 7)
 
 
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test20e(populate_db, caplog):
+	""" Inventory: the running and latest inventories dates are cached until the campaign changes """
+	assert get_running_inventory_date() is None
+	assert get_latest_inventory_date() == date.min
+	create_inventory(date=datetime.now())
+	assert get_running_inventory_date() == dt.date(2023, 2, 7)
+	assert get_latest_inventory_date() == dt.date(2023, 2, 7)
+	assert count_queries(caplog, get_running_inventory_date) == 0
+	assert count_queries(caplog, get_latest_inventory_date) == 0
+	stop_inventory_campaign()
+	assert get_running_inventory_date() is None
+	restart_inventory_campaign(Inventory.get().id)
+	assert get_running_inventory_date() == dt.date(2023, 2, 7)
+
+
 
 
 @time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
@@ -675,6 +941,97 @@ def test22e(populate_db):
 	assert [t[1] for t in get_current_inventory_remaining_items(ITEM_TYPE_BCD).query] == [1, 2, 10]
 
 
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test22g(populate_db):
+	""" Inventory: get_current_inventory_remaining_items, by pages following a reference """
+	create_inventory(date=datetime.now())
+	create_item_state(item_id=2, is_present=True, is_usable=True, date=datetime.now())
+	for days in range(1, 4):
+		create_item_state(item_id=3, is_present=True, is_usable=True, date=datetime.now() - timedelta(days=days))
+	assert [t[1] for t in get_current_inventory_remaining_items(ITEM_TYPE_BCD, limit=2).query] == [1, 3]
+	assert [t[1] for t in get_current_inventory_remaining_items(ITEM_TYPE_BCD, after=3, limit=2).query] == [10]
+	assert [t[1] for t in get_current_inventory_remaining_items(ITEM_TYPE_BCD, after=10, limit=2).query] == []
+
+
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test22f(populate_db, caplog):
+	""" Inventory: the progress counters of the running inventory are updated as the states are recorded """
+	create_inventory(date=datetime.now())
+	assert get_inventory_progress(date.today()) == (
+		('bcd', 4, 0),
+		('first_stage', 1, 0),
+		('first_stage_auxiliary', 1, 0),
+		('suit', 1, 0),
+	)
+	create_item_state(item_id=1, is_present=True, is_usable=True, date=datetime.now())
+	create_item_state(item_id=2, is_present=True, is_usable=True, date=datetime.now() - timedelta(days=3))
+	create_item_state(item_id=6, is_present=True, is_usable=True, date=datetime.now())
+	trash_item(3)
+	assert get_inventory_progress(date.today())[0] == ('bcd', 2, 1)
+	stop_inventory_campaign()
+	create_item_state(item_id=4, is_present=True, is_usable=True, date=datetime.now())
+	assert get_inventory_progress(date.today())[0] == ('bcd', 2, 1)
+	restart_inventory_campaign(Inventory.get().id)
+	assert get_inventory_progress(date.today())[0] == ('bcd', 1, 2)
+	assert count_queries(caplog, get_inventory_progress, date.today()) == 1
+
+
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test22h(populate_db, caplog):
+	""" Inventory: record the states of a batch of scanned items, the already inventoried ones are left as is """
+	create_inventory(date=datetime.now())
+	create_item_state(item_id=1, is_present=True, is_usable=False, date=datetime.now())
+	assert count_queries(caplog, create_items_states, (1, 2, 2, 3, 6), date.today(), batch_size=2) == 5
+	assert create_items_states((4, ), date.today(), is_usable=False) == [4]
+	assert get_items_last_state(ITEM_TYPE_BCD) == {
+		1: (True, False),
+		2: (True, True),
+		3: (True, True),
+		4: (True, False),
+	}
+	assert get_inventory_progress(date.today())[0] == ('bcd', 0, 4)
+	assert [t[1] for t in get_current_inventory_remaining_items(ITEM_TYPE_BCD).query] == []
+
+
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test22i(populate_db, caplog):
+	""" Inventory: carry forward the states of the previous inventory, the already inventoried items are left as is """
+	with pytest.raises(InventoryException):
+		carry_forward_states()
+	previous_date = datetime.now() - timedelta(days=6)
+	create_inventory(date=previous_date)
+	create_item_state(item_id=1, is_present=True, is_usable=False, price=30, comment="torn", date=previous_date)
+	create_item_state(item_id=2, is_present=True, is_usable=True, date=previous_date)
+	create_item_state(item_id=3, is_present=False, is_usable=True, date=previous_date)
+	create_item_state(item_id=6, is_present=True, is_usable=True, date=previous_date)
+	stop_inventory_campaign()
+	create_inventory(date=datetime.now())
+	create_item_state(item_id=2, is_present=True, is_usable=False, date=datetime.now())
+	assert count_queries(caplog, carry_forward_states, ITEM_TYPE_BCD) == 5
+	state = ItemState.get((ItemState.item_id == 1) & (ItemState.date == date.today()))
+	assert (state.is_usable, state.price, state.comment) == (False, 30, "torn")
+	assert get_items_last_state(ITEM_TYPE_BCD) == {
+		1: (True, False),
+		2: (True, False),
+		3: (False, True),
+	}
+	assert get_inventory_progress(date.today())[0] == ('bcd', 1, 3)
+	assert carry_forward_states(ITEM_TYPE_BCD) == []
+	assert carry_forward_states() == [6]
+
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test22j(populate_db):
+	""" Inventory: the states written by the CRUD pages update the current states and the progress counters """
+	create_inventory(date=datetime.now())
+	ItemState.create(item_id=1, is_present=False, is_usable=True, date=datetime.now())
+	refresh_item_states(1)
+	assert get_items_last_state(ITEM_TYPE_BCD)[1] == (False, True)
+	assert get_inventory_progress(date.today())[0] == ('bcd', 3, 1)
+	ItemState.delete().where(ItemState.item_id == 1).execute()
+	refresh_item_states(1)
+	assert 1 not in get_items_last_state(ITEM_TYPE_BCD)
+	assert get_inventory_progress(date.today())[0] == ('bcd', 4, 0)
+
 @time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
 def test23a(populate_db):
 	""" Inventory: get_latest_inventory_date """
@@ -717,6 +1074,31 @@ def test25a(populate_db):
 	]
 
 
+@time_machine.travel(dt.datetime(2023, 2, 7, 14, 38))
+def test25b(populate_db, caplog):
+	""" Inventory: missing, unusable and uninventoried items, one query each whatever the number of items """
+	create_item_state(item_id=1, is_present=False, is_usable=True, date=datetime.now())
+	create_item_state(item_id=2, is_present=True, is_usable=False, date=datetime.now())
+	create_item_state(item_id=3, is_present=True, is_usable=True, date=datetime.now())
+	create_item_state(item_id=3, is_present=False, is_usable=False, date=(datetime.now() + timedelta(days=-1)))
+	create_item_state(item_id=5, is_present=True, is_usable=False, date=datetime.now())
+	assert get_inventory_missing_items(datetime.now()) == ("Bcd 1", )
+	assert get_inventory_unusable_items(datetime.now()) == ("Bcd 2", "Main regulator 1")
+	assert get_uninventoried_items(datetime.now()) == (
+		"Bcd 10",
+		"Auxiliary regulator 1",
+		"Manometer 1",
+		"Manometer 2",
+		"Octopus 1",
+		"Octopus 2",
+		"Octopus 3",
+		"Second stage 1",
+		"Suit 1",
+	)
+	for func in (get_inventory_missing_items, get_inventory_unusable_items, get_uninventoried_items):
+		assert count_queries(caplog, func, datetime.now()) == 1
+
+
 @time_machine.travel(dt.datetime(2021, 10, 1))
 def test26a(populate_db):
 	""" Get items last state, no state in the DB """
@@ -726,7 +1108,7 @@ def test26a(populate_db):
 @time_machine.travel(dt.datetime(2021, 10, 1))
 def test26b(populate_db):
 	""" Get items last state, one state in the DB """
-	ItemState.create(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
 	assert get_items_last_state("bcd") == {
 		3: (True, True),
 	}
@@ -735,9 +1117,9 @@ def test26b(populate_db):
 @time_machine.travel(dt.datetime(2021, 10, 1))
 def test26c(populate_db):
 	""" Get items last state, several states in the DB for this item """
-	ItemState.create(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
-	ItemState.create(item_id=3, date="2021-09-10", is_present=True, is_usable=True)
-	ItemState.create(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-10", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
 	assert get_items_last_state("bcd") == {
 		3: (False, True),
 	}
@@ -746,10 +1128,10 @@ def test26c(populate_db):
 @time_machine.travel(dt.datetime(2021, 10, 1))
 def test26d(populate_db):
 	""" Get items last state, multiple items of the same type have states """
-	ItemState.create(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
-	ItemState.create(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
-	ItemState.create(item_id=1, date="2021-08-01", is_present=False, is_usable=False)
-	ItemState.create(item_id=1, date="2021-09-09", is_present=True, is_usable=False)
+	create_item_state(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
+	create_item_state(item_id=1, date="2021-08-01", is_present=False, is_usable=False)
+	create_item_state(item_id=1, date="2021-09-09", is_present=True, is_usable=False)
 	assert get_items_last_state("bcd") == {
 		1: (True, False),
 		3: (False, True),
@@ -759,11 +1141,40 @@ def test26d(populate_db):
 @time_machine.travel(dt.datetime(2021, 10, 1))
 def test26e(populate_db):
 	""" Get items last state, several items of different types have states """
+	create_item_state(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-10", is_present=True, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
+	create_item_state(item_id=5, date="2021-09-12", is_present=True, is_usable=True)
+	assert get_items_last_state("bcd") == {
+		3: (False, True),
+	}
+
+
+
+@time_machine.travel(dt.datetime(2021, 10, 1))
+def test26f(populate_db):
+	""" Get items last state, states are not recorded chronologically """
+	create_item_state(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
+	create_item_state(item_id=3, date="2021-09-09", is_present=True, is_usable=False)
+	assert get_items_last_state("bcd") == {
+		3: (False, True),
+	}
+
+
+@time_machine.travel(dt.datetime(2021, 10, 1))
+def test26g(populate_db):
+	""" Get items last state, once rebuilt from the states history """
 	ItemState.create(item_id=3, date="2021-09-09", is_present=True, is_usable=True)
-	ItemState.create(item_id=3, date="2021-09-10", is_present=True, is_usable=True)
 	ItemState.create(item_id=3, date="2021-09-11", is_present=False, is_usable=True)
-	ItemState.create(item_id=5, date="2021-09-12", is_present=True, is_usable=True)
+	ItemState.create(item_id=1, date="2021-09-09", is_present=True, is_usable=False)
+	assert get_items_last_state("bcd") == {}
+	refresh_items_current_state()
+	assert get_items_last_state("bcd") == {
+		1: (True, False),
+		3: (False, True),
+	}
+	ItemState.delete().where(ItemState.item_id == 1).execute()
+	refresh_items_current_state((1, ))
 	assert get_items_last_state("bcd") == {
 		3: (False, True),
 	}
-
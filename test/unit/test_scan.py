@@ -0,0 +1,67 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+from webapp.scan import DEFAULT_SCAN_DECODER, get_scan_decoder
+
+CONFIG_QRCODE = {
+	'item': r"https://gear.jellyfish.org/%s",
+	'license': "https://l.ffessm.fr/c.asp?id=%s_85648D",
+}
+
+CONFIG_REF_PREFIXES = {
+	'first_stage': "D",
+	'suit': "C",
+	'bcd': "S",
+	'hood': "CG",
+	'mask': "M",
+}
+
+
+def test01a():
+	""" Found item """
+	decoder = get_scan_decoder(CONFIG_QRCODE, CONFIG_REF_PREFIXES)
+	assert decoder.decode("https://gear.jellyfish.org/CG3") == {
+		'item_type': "hood",
+		'item_reference': "3",
+	}
+	assert decoder.decode("https://gear.jellyfish.org/C12") == {
+		'item_type': "suit",
+		'item_reference': "12",
+	}
+
+
+def test01b():
+	""" Found license """
+	decoder = get_scan_decoder(CONFIG_QRCODE, CONFIG_REF_PREFIXES)
+	assert decoder.decode("https://l.ffessm.fr/c.asp?id=1234567_85648D") == {
+		'license_nb': "1234567",
+	}
+
+
+def test01c():
+	""" Malformed texts are decoded as nothing """
+	decoder = get_scan_decoder(CONFIG_QRCODE, CONFIG_REF_PREFIXES)
+	for text in (None, "", "garbage", "https://gear.jellyfish.org/", "https://gear.jellyfish.org/X3",
+			"https://gear.jellyfish.org/M", "https://gear.jellyfish.org/3", "https://gear.jellyfishXorg/M3",
+			"https://l.ffessm.fr/c.asp?id=_85648D"):
+		assert decoder.decode(text) == {}
+
+
+def test01d():
+	""" The decoder is compiled once for a given configuration """
+	assert get_scan_decoder(CONFIG_QRCODE, CONFIG_REF_PREFIXES) is get_scan_decoder(dict(CONFIG_QRCODE), CONFIG_REF_PREFIXES)
+
+
+def test02a():
+	""" Split an item code """
+	decoder = get_scan_decoder(CONFIG_QRCODE, CONFIG_REF_PREFIXES)
+	assert decoder.split_code("CG3") == ("hood", "3")
+	assert decoder.split_code("S1") == ("bcd", "1")
+	for code in (None, "", "S", "1", "X1", "s1", "S1a"):
+		assert decoder.split_code(code) is None
+
+
+def test02b():
+	""" The decoder of the configuration is built once """
+	assert get_scan_decoder() is DEFAULT_SCAN_DECODER
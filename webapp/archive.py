@@ -0,0 +1,116 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Zip archives streamed while their content is produced, without temporary files
+
+"""
+import logging
+import subprocess
+from io import RawIOBase
+from tempfile import TemporaryFile
+from time import localtime
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from flask import Response, stream_with_context
+
+_LOGGER = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# already compressed contents, stored as is in the archives
+STORED_EXTENSIONS = (".dump", ".gz", ".jpeg", ".jpg", ".pdf", ".png", ".zip")
+
+
+class ArchiveException(Exception):
+	pass
+
+
+class _StreamBuffer(RawIOBase):
+	"""
+	Unseekable file object keeping what ZipFile wrote until it is popped
+
+	"""
+
+	def __init__(self):
+		self._chunks = []
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self._chunks.append(bytes(data))
+		return len(data)
+
+	def pop(self):
+		data = b"".join(self._chunks)
+		self._chunks = []
+		return data
+
+
+def file_chunks(filepath, chunk_size=CHUNK_SIZE):
+	with open(filepath, 'rb') as fobj:
+		while chunk := fobj.read(chunk_size):
+			yield chunk
+
+
+def command_chunks(args, chunk_size=CHUNK_SIZE):
+	"""
+	Yields the standard output of the command, raises an ArchiveException if it fails. The standard error goes to a
+	temporary file: a pipe left unread while the output is streamed would block the command once full
+
+	"""
+	_LOGGER.debug("Executing command '%s'", " ".join(args))
+	with TemporaryFile() as stderr:
+		with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr) as process:
+			while chunk := process.stdout.read(chunk_size):
+				yield chunk
+		if process.returncode != 0:
+			stderr.seek(0)
+			_LOGGER.error("Command '%s' failed: %s", " ".join(args), stderr.read().decode(errors="replace"))
+			raise ArchiveException("Command '%s' failed with exit status %d" % (args[0], process.returncode))
+
+
+def stream_zip(entries):
+	"""
+	entries is an iterable of (name in the archive, content) where the content is either bytes or an iterable of
+	bytes chunks. The archive is yielded by chunks as soon as they are compressed
+
+	"""
+	buffer = _StreamBuffer()
+	with ZipFile(buffer, 'w', compression=ZIP_DEFLATED) as zipobj:
+		for arcname, content in entries:
+			_LOGGER.debug("Adding '%s'", arcname)
+			if isinstance(content, bytes):
+				content = (content, )
+			zinfo = ZipInfo(arcname, date_time=localtime()[:6])
+			zinfo.compress_type = ZIP_STORED if arcname.lower().endswith(STORED_EXTENSIONS) else ZIP_DEFLATED
+			with zipobj.open(zinfo, 'w', force_zip64=True) as member:
+				for chunk in content:
+					member.write(chunk)
+					data = buffer.pop()
+					if data:
+						yield data
+			yield buffer.pop()
+	yield buffer.pop()
+
+
+def _then(chunks, callback):
+	"""
+	Yields the chunks then calls callback: the WSGI server only asks for the chunk following the last one once it has
+	sent it, so an aborted download never reaches the callback
+
+	"""
+	yield from chunks
+	callback()
+
+
+def zip_response(entries, filename, on_complete=None):
+	chunks = stream_zip(entries)
+	if on_complete is not None:
+		chunks = _then(chunks, on_complete)
+	return Response(
+		stream_with_context(chunks),
+		mimetype="application/zip",
+		headers={'Content-Disposition': 'attachment; filename="%s"' % filename},
+	)
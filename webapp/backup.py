@@ -0,0 +1,286 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+"""
+Full and incremental backups of the database and of the servicing reports
+
+A backup archive holds a custom format (compressed) dump of the database and a manifest of the sha256 of every
+servicing report. An incremental backup only holds the reports which changed since the previous backup, whose id
+is recorded as its base: the reports of a chain of backups are restored by restore_servicing_files()
+
+"""
+import json
+import logging
+import shlex
+import subprocess
+from datetime import datetime
+from hashlib import sha256
+from os import chmod, cpu_count, environ, makedirs, replace
+from os.path import basename, expanduser, isfile, join
+from tempfile import NamedTemporaryFile
+from zipfile import ZipFile
+
+from weblib.models import WEBLIB_MODELS, flask_db
+from weblib.requests import DatabaseException
+from weblib.utils import Shell
+
+from webapp import CONFIG_FILEPATH
+from webapp.archive import CHUNK_SIZE, command_chunks, file_chunks
+from webapp.models import MODELS
+from webapp.requests import get_servicing_files, invalidate_inventory_campaign, invalidate_items
+
+_LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+LAST_MANIFEST_NAME = "last_manifest.json"
+
+
+class BackupException(Exception):
+	pass
+
+
+def get_backup_dir():
+	return environ.get('BACKUP_DIR', join(environ['HOME'], "backups"))
+
+
+def file_sha256(filepath):
+	digest = sha256()
+	for chunk in file_chunks(filepath, CHUNK_SIZE):
+		digest.update(chunk)
+	return digest.hexdigest()
+
+
+def load_last_manifest(backup_dir):
+	try:
+		with open(join(backup_dir, LAST_MANIFEST_NAME)) as fobj:
+			return json.load(fobj)
+	except FileNotFoundError:
+		return None
+
+
+def save_last_manifest(backup_dir, manifest):
+	makedirs(backup_dir, exist_ok=True)
+	filepath = join(backup_dir, LAST_MANIFEST_NAME)
+	with open("%s.tmp" % filepath, 'w') as fobj:
+		json.dump(manifest, fobj, indent=1)
+	replace("%s.tmp" % filepath, filepath)
+
+
+def backup_db(db_name, incremental=False, backup_dir=None):
+	"""
+	Returns the (name, content) entries of a backup archive, each content being produced while it is archived, and a
+	function recording its manifest as the base of the next incremental backup. It must only be called once the whole
+	archive has been delivered, so that an aborted download is not the base of the next incremental backup
+
+	"""
+	backup_dir = backup_dir or get_backup_dir()
+	manifest = {}
+
+	def record_manifest():
+		if not manifest.get('is_complete'):
+			_LOGGER.warning("The backup archive has not been fully produced -> its manifest is not recorded")
+			return
+		try:
+			save_last_manifest(backup_dir, {key: value for key, value in manifest.items() if key != 'is_complete'})
+		except OSError:
+			_LOGGER.exception("Could not record the backup manifest in '%s'", backup_dir)
+
+	return _backup_entries(db_name, incremental, backup_dir, manifest), record_manifest
+
+
+def _backup_entries(db_name, incremental, backup_dir, manifest):
+	base_manifest = load_last_manifest(backup_dir) if incremental else None
+	if incremental and base_manifest is None:
+		_LOGGER.warning("No previous backup found -> doing a full backup")
+	manifest.update({
+		'id': datetime.now().strftime("%Y-%m-%dT%H-%M-%S"),
+		'base': base_manifest['id'] if base_manifest else None,
+		'database': "%s.dump" % db_name,
+		'servicings': {},
+	})
+
+	yield "config.ini", file_chunks(CONFIG_FILEPATH)
+
+	_LOGGER.info("Creating a compressed SQL backup of the database")
+	yield manifest['database'], command_chunks(["pg_dump", "--format=custom", "--no-owner", db_name])
+
+	if base_manifest is None:
+		_LOGGER.info("Creating a CSV backup of the database")
+		for table_name in [m._meta.table_name.lower() for m in MODELS + WEBLIB_MODELS]:
+			copy_cmd = f"\\copy (SELECT * FROM \"{table_name}\" ORDER BY id) to stdout csv HEADER DELIMITER ';'"
+			yield f"csv/{table_name}.csv", command_chunks(["psql", db_name, "-c", copy_cmd])
+
+	base_servicings = base_manifest['servicings'] if base_manifest else {}
+	copied_count = 0
+	for hashed_filename, exported_filename in get_servicing_files():
+		src = expanduser(f"~/{hashed_filename}")
+		if not isfile(src):
+			_LOGGER.error("'%s' referenced in DB but not found on filesystem !", src)
+			continue
+		digest = file_sha256(src)
+		manifest['servicings'][hashed_filename] = {'name': exported_filename, 'sha256': digest}
+		if base_servicings.get(hashed_filename, {}).get('sha256') == digest:
+			continue
+		copied_count += 1
+		yield f"servicings/{exported_filename}", file_chunks(src)
+	_LOGGER.info("%d servicing files copied out of %d", copied_count, len(manifest['servicings']))
+
+	yield MANIFEST_NAME, json.dumps(manifest, indent=1).encode()
+	manifest['is_complete'] = True
+
+
+def read_manifest(zipobj):
+	try:
+		return json.loads(zipobj.read(MANIFEST_NAME))
+	except KeyError:
+		raise BackupException("'%s' has no manifest" % zipobj.filename)
+
+
+def restore_servicing_files(archives_filepaths, dest_dir):
+	"""
+	Restore the servicing reports of a chain of backups, given from the full one to the latest incremental one
+
+	"""
+	zipobjs = [ZipFile(filepath) for filepath in archives_filepaths]
+	try:
+		manifests = [read_manifest(zipobj) for zipobj in zipobjs]
+		if manifests[0]['base'] is not None:
+			raise BackupException("The first backup of the chain must be a full backup")
+		for base, manifest in zip(manifests, manifests[1:]):
+			if manifest['base'] != base['id']:
+				raise BackupException("Backup '%s' is not based on backup '%s'" % (manifest['id'], base['id']))
+
+		for hashed_filename, servicing in manifests[-1]['servicings'].items():
+			# the names come from the archives: they must not lead out of dest_dir
+			if basename(hashed_filename) != hashed_filename or hashed_filename in ("", ".", ".."):
+				raise BackupException("Invalid servicing file name '%s'" % hashed_filename)
+			arcname = f"servicings/{servicing['name']}"
+			for zipobj, manifest in reversed(tuple(zip(zipobjs, manifests))):
+				if manifest['servicings'].get(hashed_filename, {}).get('sha256') != servicing['sha256']:
+					raise BackupException("'%s' is missing from the backups chain" % servicing['name'])
+				if arcname in zipobj.namelist():
+					_LOGGER.debug("Restoring '%s' from backup '%s'", servicing['name'], manifest['id'])
+					with zipobj.open(arcname) as src, open(join(dest_dir, hashed_filename), 'wb') as dst:
+						while chunk := src.read(CHUNK_SIZE):
+							dst.write(chunk)
+					break
+			else:
+				raise BackupException("'%s' is missing from the backups chain" % servicing['name'])
+	finally:
+		for zipobj in zipobjs:
+			zipobj.close()
+
+
+def _copy_with_progress(src, dst, total_size, what):
+	copied_size = 0
+	next_report = 10
+	while chunk := src.read(CHUNK_SIZE):
+		dst.write(chunk)
+		copied_size += len(chunk)
+		if total_size and copied_size * 100 >= next_report * total_size:
+			_LOGGER.info("%s: %d%%", what, copied_size * 100 // total_size)
+			next_report = copied_size * 100 // total_size + 10
+
+
+def _run_restore(args, dump, total_size):
+	"""
+	Streams the dump into the standard input of the command
+
+	"""
+	_LOGGER.debug("Executing command '%s'", " ".join(args))
+	with subprocess.Popen(args, stdin=subprocess.PIPE) as process:
+		try:
+			_copy_with_progress(dump, process.stdin, total_size, "Restoring the database")
+			process.stdin.close()
+		except BrokenPipeError:
+			_LOGGER.error("'%s' stopped before the end of the dump", args[0])
+	return process.returncode
+
+
+def _run_parallel_restore(args, dump, total_size):
+	"""
+	pg_restore needs a file to restore with several jobs, it reports each restored object
+
+	"""
+	with NamedTemporaryFile(suffix=".dump") as fobj:
+		_copy_with_progress(dump, fobj, total_size, "Extracting the dump")
+		fobj.flush()
+		# the restore is run as postgres
+		chmod(fobj.name, 0o644)
+		args = args + ["--verbose", fobj.name]
+		_LOGGER.debug("Executing command '%s'", " ".join(args))
+		with subprocess.Popen(args, stderr=subprocess.PIPE, text=True) as process:
+			for line in process.stderr:
+				_LOGGER.info("Restoring the database: %s", line.strip())
+	return process.returncode
+
+
+def find_database_dump(zipobj):
+	try:
+		return read_manifest(zipobj)['database']
+	except BackupException:
+		for name in zipobj.namelist():
+			if name.endswith((".sql", ".dump")) and "/" not in name:
+				return name
+	raise BackupException("No database dump found in '%s'" % zipobj.filename)
+
+
+def restore_db(zipobj, dbname="jellyfish", jobs=None):
+	"""
+	Recreates the database from the dump of a backup archive: plain SQL dumps are streamed into psql, custom format
+	dumps are restored by pg_restore with several jobs
+
+	"""
+	dump_name = find_database_dump(zipobj)
+	dump_size = zipobj.getinfo(dump_name).file_size
+	jobs = jobs or cpu_count() or 1
+	fmt_dict = {
+		'dbname': dbname,
+	}
+	sh = Shell()
+	_LOGGER.info("Restoring DB from '%s' (%d bytes)...", dump_name, dump_size)
+	flask_db.database.close()
+	sh.execute("psql %(dbname)s -c \"SELECT pid, (SELECT pg_terminate_backend(pid)) as killed from pg_stat_activity WHERE state LIKE 'idle';\"" % fmt_dict)
+	_LOGGER.debug(sh.stdout)
+	sh.execute("sudo -u postgres dropdb %(dbname)s" % fmt_dict)
+	_LOGGER.debug(sh.stdout)
+	sh.execute("sudo -u postgres createdb -T template0 %(dbname)s" % fmt_dict)
+	_LOGGER.debug(sh.stdout)
+	if sh.retcode != 0:
+		raise DatabaseException("Could not create DB '%s'" % dbname)
+
+	with zipobj.open(dump_name) as dump:
+		if not dump_name.endswith(".dump"):
+			retcode = _run_restore(shlex.split("sudo -u postgres psql --set ON_ERROR_STOP=on %(dbname)s" % fmt_dict), dump, dump_size)
+		elif jobs > 1:
+			retcode = _run_parallel_restore(shlex.split("sudo -u postgres pg_restore --no-owner --exit-on-error -j %d -d %s" % (jobs, dbname)), dump, dump_size)
+		else:
+			retcode = _run_restore(shlex.split("sudo -u postgres pg_restore --no-owner --exit-on-error -d %(dbname)s" % fmt_dict), dump, dump_size)
+	if retcode != 0:
+		raise DatabaseException("Could not restore DB, exit status is %d" % retcode)
+	invalidate_items()
+	invalidate_inventory_campaign()
+	_LOGGER.info("DB sucsessfuly restored")
+
+
+def restore_backups(archives, dbname="jellyfish", jobs=None):
+	"""
+	Restores the servicing reports of a chain of backup archives given in any order, then the database from the
+	latest one. A legacy archive without manifest can only be restored alone, for its database
+
+	"""
+	manifests_ids = []
+	for archive in archives:
+		with ZipFile(archive) as zipobj:
+			try:
+				manifests_ids.append(read_manifest(zipobj)['id'])
+			except BackupException:
+				manifests_ids.append(None)
+	if None in manifests_ids and len(archives) != 1:
+		raise BackupException("A backup without manifest can not be part of a chain")
+	archives = [archive for _, archive in sorted(zip(manifests_ids, archives), key=lambda pair: pair[0] or "")]
+	if manifests_ids != [None]:
+		restore_servicing_files(archives, expanduser("~"))
+	with ZipFile(archives[-1]) as zipobj:
+		restore_db(zipobj, dbname, jobs)
@@ -0,0 +1,168 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+from os import getpid
+from select import select
+from threading import Lock, Thread
+from time import sleep
+
+from flask import g, has_request_context
+
+_LOGGER = logging.getLogger(__name__)
+
+_PROCESS_CACHES = []
+
+
+class ProcessCache:
+	"""
+	In-process cache of query results. The values are loaded on demand and kept until the cache is invalidated.
+
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self._values = {}
+		self._generation = 0
+		self.hits = 0
+		self.misses = 0
+		_PROCESS_CACHES.append(self)
+
+	def get(self, key, loader):
+		try:
+			value = self._values[key]
+		except KeyError:
+			pass
+		else:
+			self.hits += 1
+			return value
+		self.misses += 1
+		generation = self._generation
+		value = loader()
+		if generation == self._generation:  # do not keep a value that may have been loaded before an invalidation
+			self._values[key] = value
+		return value
+
+	def invalidate(self, key=None):
+		_LOGGER.debug("Invalidating '%s' cache (key=%s)", self.name, key)
+		self._generation += 1
+		if key is None:
+			self._values.clear()
+		else:
+			self._values.pop(key, None)
+
+	@property
+	def stats(self):
+		return {'size': len(self._values), 'hits': self.hits, 'misses': self.misses}
+
+
+def get_process_caches_stats():
+	return {cache.name: cache.stats for cache in _PROCESS_CACHES}
+
+
+class RequestCache:
+	"""
+	Cache of query results kept in flask.g for the duration of the current request. Outside of a request context the
+	values are loaded on every call.
+
+	"""
+
+	def __init__(self, name):
+		self.name = name
+		self._attribute = "request_cache_%s" % name
+
+	def _values(self):
+		if not has_request_context():
+			return None
+		return g.setdefault(self._attribute, {})
+
+	def get(self, key, loader):
+		values = self._values()
+		if values is None:
+			return loader()
+		try:
+			return values[key]
+		except KeyError:
+			pass
+		value = values[key] = loader()
+		return value
+
+	def invalidate(self, key=None):
+		values = self._values()
+		if values is None:
+			return
+		_LOGGER.debug("Invalidating '%s' request cache (key=%s)", self.name, key)
+		if key is None:
+			values.clear()
+		else:
+			values.pop(key, None)
+
+
+class InvalidationListener:
+	"""
+	Keeps the process caches of several workers coherent. The processes which listen to the Postgres **channel**
+	notify it when they modify the cached data, and invalidate their **caches** when another process did.
+
+	"""
+	POLL_TIMEOUT = 60
+	RETRY_DELAY = 10
+
+	def __init__(self, channel, caches):
+		self.channel = channel
+		self.caches = caches
+		self._lock = Lock()
+		self._pid = None
+
+	@property
+	def is_listening(self):
+		return self._pid == getpid()
+
+	def start(self, connect):
+		"""
+		Start the listening thread unless it already runs in this process (threads do not survive a fork).
+		**connect** returns a new psycopg2 connection
+
+		"""
+		with self._lock:
+			if self.is_listening:
+				return
+			self._pid = getpid()
+		Thread(target=self._run, args=(connect, ), name="%s listener" % self.channel, daemon=True).start()
+
+	def notify(self, database):
+		if self.is_listening:
+			database.execute_sql("SELECT pg_notify(%s, %s)", (self.channel, str(getpid())))
+
+	def _invalidate(self):
+		for cache in self.caches:
+			cache.invalidate()
+
+	def _run(self, connect):
+		while True:
+			try:
+				self._listen(connect)
+			except Exception:
+				_LOGGER.exception("Stopped listening to '%s', will retry in %ds", self.channel, self.RETRY_DELAY)
+			sleep(self.RETRY_DELAY)
+
+	def _listen(self, connect):
+		connection = connect()
+		try:
+			connection.autocommit = True
+			with connection.cursor() as cursor:
+				cursor.execute('LISTEN "%s"' % self.channel)
+			_LOGGER.info("Listening to '%s'", self.channel)
+			# the notifications sent while not listening are lost
+			self._invalidate()
+			own_payload = str(getpid())
+			while True:
+				if not select([connection], [], [], self.POLL_TIMEOUT)[0]:
+					continue
+				connection.poll()
+				payloads = set(notify.payload for notify in connection.notifies)
+				connection.notifies.clear()
+				if payloads - {own_payload}:
+					self._invalidate()
+		finally:
+			connection.close()
@@ -4,25 +4,19 @@
 #
 import csv
 import logging
-import shlex
-import subprocess
-from os import chdir, getcwd
-from shutil import rmtree
-from tempfile import mkdtemp
-from zipfile import ZipFile
+from io import BytesIO, TextIOWrapper
 
+from flask import flash
 from flask_babel import gettext as _, lazy_gettext as _l
-from os.path import join
-from webapp.requests import delete_all_members, get_borrowed_items
+from webapp.requests import get_borrowed_items, sync_members
 from weblib.requests import DatabaseException
 
 from webapp import CONFIG_CUSTOMIZATION
+from webapp.backup import BackupException, restore_backups
 from webapp.models import Item, ItemState, Member, Servicing
 from weblib.forms.fields import (BooleanField, DateField, DecimalField, DoubleSelectField, FileField, HiddenField,
 	IntegerField, PriceField, SelectField, TextAreaField, TextField)
 from weblib.forms.forms import BaseForm
-from weblib.models import flask_db
-from weblib.utils import Shell
 
 
 _LOGGER = logging.getLogger(__name__)
@@ -336,50 +330,21 @@ class InventorySelectForm(BaseForm):
 	}
 
 
-def restore_db(sql_dump_filepath):
-	fmt_dict = {
-		'dbname': "jellyfish",
-		'sql_dump_filepath': sql_dump_filepath,
-	}
-	sh = Shell()
-	_LOGGER.info("Restoring DB...")
-	flask_db.database.close()
-	sh.execute("psql jellyfish -c \"SELECT pid, (SELECT pg_terminate_backend(pid)) as killed from pg_stat_activity WHERE state LIKE 'idle';\"")
-	_LOGGER.debug(sh.stdout)
-	sh.execute("sudo -u postgres dropdb %(dbname)s" % fmt_dict)
-	_LOGGER.debug(sh.stdout)
-	sh.execute("sudo -u postgres createdb -T template0 %(dbname)s" % fmt_dict)
-	_LOGGER.debug(sh.stdout)
-	with open(sql_dump_filepath, 'rb') as fobj:
-		stdin = fobj.read()
-	sp = subprocess.Popen(shlex.split("sudo -u postgres psql --set ON_ERROR_STOP=on %(dbname)s" % fmt_dict), stdin=subprocess.PIPE)
-	sp.communicate(input=stdin)
-	if sh.retcode != 0:
-		raise DatabaseException("Could not restore DB")
-	_LOGGER.info("DB sucsessfuly restored")
-
-
-def restore_db_action(file_content):
-	tmpdir = mkdtemp()
-	from_dir = getcwd()
+def restore_backups_action(archives):
 	try:
-		chdir(tmpdir)
-		zip_filepath = "./zipfile.zip"
-		with open(zip_filepath, 'wb') as f:
-			f.write(file_content)
-		_LOGGER.info("Exctracting dump to '%s'", tmpdir)
-		with ZipFile(zip_filepath, 'r') as zipobj:
-			zipobj.extract("jellyfish.sql")
-		try:
-			restore_db(join(tmpdir, "jellyfish.sql"))
-		except DatabaseException:
-			_LOGGER.exception("Restore DB failed")
+		restore_backups(archives)
+	except (BackupException, DatabaseException) as error:
+		_LOGGER.exception("Restore DB failed")
+		flash(_("Could not restore the database: %(error)s", error=error), 'danger')
 	except:
 		_LOGGER.exception("Zip extraction failed")
-	finally:
-		chdir(from_dir)
-		_LOGGER.info("Cleanup temp dir '%s'", tmpdir)
-		rmtree(tmpdir)
+		flash(_("Could not restore the database"), 'danger')
+	else:
+		flash(_("Database restored"), 'success')
+
+
+def restore_db_action(file_content):
+	restore_backups_action((BytesIO(file_content), ))
 
 
 class UploadDBForm(BaseForm):
@@ -388,38 +353,43 @@ class UploadDBForm(BaseForm):
 	}
 
 
+class UploadBackupsChainForm(BaseForm):
+	# several files are uploaded at once, they are read by the view
+	fields = {
+		'zipfiles': FileField(_l("Chain of backup zip files, the full one and its incremental ones"), required=True),
+	}
+
+
+def read_members_csv(fobj):
+	"""
+	Yields the members of the CSV file object as dicts
+
+	"""
+	csv_reader = csv.reader(fobj, delimiter=',')
+	header_fields = ("last_name", "first_name", "license_nb")
+	for row in csv_reader:
+		if csv_reader.line_num == 1:
+			if tuple(row) != header_fields:
+				raise ValueError("header '%s' is different from expected '%s'" % (row, header_fields))
+		elif row:
+			if len(row) != len(header_fields):
+				raise ValueError("line %d has %d fields instead of %d" % (csv_reader.line_num, len(row), len(header_fields)))
+			yield dict(zip(header_fields, [f.strip() for f in row]))
+
+
 def populate_members(file_content):
 	_LOGGER.info("Populating the members' list...")
-	origin_dir = getcwd()
 	try:
-		tmpdir = mkdtemp()
-		_LOGGER.info("Creating temporary working dir '%s'", tmpdir)
-		chdir(tmpdir)
-		filename = "members.csv"
-		with open(filename, 'wb') as f:
-			f.write(file_content)
-		with open(filename, newline='') as fobj:
-			csv_reader = csv.reader(fobj, delimiter=',')
-			header_fields = ("last_name", "first_name", "license_nb")
-			n_upplets = []
-			for row in csv_reader:
-				if csv_reader.line_num == 1:
-					try:
-						assert tuple(row) == header_fields
-					except AssertionError:
-						_LOGGER.exception("header '%s' is different from expected '%s'", row, header_fields)
-						raise
-				else:
-					n_upplets.append([f.strip() for f in row])
-		delete_all_members()
-		for n_upplet in n_upplets:
-			Member.create(**dict(zip(header_fields, n_upplet)))
+		with TextIOWrapper(BytesIO(file_content), newline='') as fobj:
+			counts = sync_members(read_members_csv(fobj))
+	except ValueError as error:
+		_LOGGER.exception("Invalid members file")
+		flash(_("Could not import the members: %(error)s", error=error), 'danger')
 	except:
 		_LOGGER.exception("Error during file processing")
-	finally:
-		chdir(origin_dir)
-		_LOGGER.info("Cleanup temporary working dir '%s'", tmpdir)
-		rmtree(tmpdir)
+		flash(_("Could not import the members"), 'danger')
+	else:
+		flash(_("Members imported: %(inserted)d added, %(updated)d updated, %(unchanged)d unchanged, %(removed)d removed", **counts), 'success')
 
 
 class UploadMembersForm(BaseForm):
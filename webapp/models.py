@@ -6,7 +6,8 @@ import logging
 
 from flask_babel import lazy_gettext as _l
 from peewee import (
-	SQL, BooleanField, CharField, DateField, DateTimeField, DecimalField, ForeignKeyField, IntegerField, TextField
+	JOIN, SQL, BooleanField, CharField, DateField, DateTimeField, DecimalField, ForeignKeyField, IntegerField, TextField,
+	Value, fn
 )
 from weblib.database import AbstractMigrator
 from weblib.models import BaseModel, FileField, MigratorException, PriceField, User, flask_db
@@ -151,6 +152,12 @@ class IsComposedOf(BaseModel):
 	child = ForeignKeyField(Item)
 	at_date = DateField()
 
+	class Meta:
+		indexes = (
+			(('child', 'at_date'), False),
+			(('parent', 'at_date'), False),
+		)
+
 
 class Inventory(BaseModel):
 	date = DateField(unique=True)
@@ -159,6 +166,17 @@ class Inventory(BaseModel):
 	in_progress.i18n = _l("In progress")
 
 
+class InventoryProgress(BaseModel):
+	# remaining and done items of each type during an inventory, see webapp.requests.refresh_inventory_progress()
+	inventory = ForeignKeyField(Inventory, backref="inventories", on_delete="CASCADE")
+	type = TextField()
+	remaining_count = IntegerField()
+	done_count = IntegerField()
+
+	class Meta:
+		constraints = [SQL('UNIQUE (inventory_id, type)')]
+
+
 class Club(BaseModel):
 	name = TextField()
 
@@ -185,6 +203,9 @@ class Member(BaseModel):
 		constraints = [SQL('UNIQUE (last_name, first_name)')]
 
 
+# members are synchronized and found from their license number, see webapp.requests.sync_members()
+Member.add_index(Member.index(Member.license_nb, unique=True, name="member_license_nb").where(Member.license_nb != ""))
+
 class Servicing(BaseModel):
 	item_id = ForeignKeyField(Item, backref="items")
 	date = DateField(null=False)
@@ -210,6 +231,14 @@ class ItemState(BaseModel):
 		constraints = [SQL('UNIQUE (item_id, date)')]
 
 
+class ItemCurrentState(BaseModel):
+	# projection of the latest ItemState of each item, see webapp.requests.refresh_items_current_state()
+	item_id = ForeignKeyField(Item, backref="items", unique=True)
+	date = DateField()
+	is_present = BooleanField()
+	is_usable = BooleanField()
+
+
 class Borrow(BaseModel):
 	item = ForeignKeyField(Item, backref="items")
 	user = ForeignKeyField(User, backref="users", null=True)
@@ -224,6 +253,9 @@ class Borrow(BaseModel):
 	usage_counter.i18n = _l("Usage counter")
 
 
+# at most one open loan per item, also used to look up the open loans
+Borrow.add_index(Borrow.index(Borrow.item, unique=True, name="borrow_item_id_open").where(Borrow.to_datetime.is_null()))
+
 # ~class BelongToMember(BaseModel):
 	# ~item = ForeignKeyField(Item, backref="items")
 	# ~member = ForeignKeyField(Member, backref="members")
@@ -251,6 +283,7 @@ MODELS = [
 	Item,
 	IsComposedOf,
 	Inventory,
+	InventoryProgress,
 	Club,
 	BelongToClub,
 	Member,
@@ -259,12 +292,13 @@ MODELS = [
 	# ~Location,
 	# ~LocatedAt,
 	ItemState,
+	ItemCurrentState,
 	Servicing,
 	# ~Repairs,
 ]
 
 
-VERSION = 12
+VERSION = 17
 
 class Migrator(AbstractMigrator):
 	"""
@@ -353,3 +387,65 @@ class Migrator(AbstractMigrator):
 		self._migrate(
 			self._migrator.add_constraint('member', 'member_last_name_first_name_key', SQL('UNIQUE (last_name, first_name)')),
 		)
+
+	def migrate_to_version_13(self):
+		self._db.create_tables((ItemCurrentState, ))
+		last_states = (ItemState
+			.select(ItemState.item_id, ItemState.date, ItemState.is_present, ItemState.is_usable)
+			.order_by(ItemState.item_id, ItemState.date.desc())
+			.distinct(ItemState.item_id)
+		)
+		fields = [ItemCurrentState.item_id, ItemCurrentState.date, ItemCurrentState.is_present, ItemCurrentState.is_usable]
+		_LOGGER.warning("Will populate the current state of the items")
+		query = ItemCurrentState.insert_from(last_states, fields)
+		query.execute()
+
+	def migrate_to_version_14(self):
+		self._migrate(
+			self._migrator.add_index('iscomposedof', ('child_id', 'at_date')),
+			self._migrator.add_index('iscomposedof', ('parent_id', 'at_date')),
+		)
+
+	def migrate_to_version_15(self):
+		latest_open_loans = (Borrow
+			.select(Borrow.id)
+			.where(Borrow.to_datetime == None)
+			.order_by(Borrow.item_id, Borrow.from_datetime.desc(), Borrow.id.desc())
+			.distinct(Borrow.item_id)
+		)
+		query = Borrow.update({Borrow.to_datetime: Borrow.from_datetime}).where((Borrow.to_datetime == None) & Borrow.id.not_in(latest_open_loans))
+		closed_count = query.execute()
+		if closed_count:
+			_LOGGER.warning("Closed %d loans of items that were borrowed several times", closed_count)
+		self._db.execute_sql('CREATE UNIQUE INDEX "borrow_item_id_open" ON "borrow" ("item_id") WHERE ("to_datetime" IS NULL)')
+
+	def migrate_to_version_16(self):
+		Member.update({Member.license_nb: None}).where(Member.license_nb == "").execute()
+		first_holders = (Member
+			.select(fn.MIN(Member.id))
+			.where(Member.license_nb.is_null(False))
+			.group_by(Member.license_nb)
+		)
+		query = Member.update({Member.license_nb: None}).where(Member.license_nb.is_null(False) & Member.id.not_in(first_holders))
+		cleared_count = query.execute()
+		if cleared_count:
+			_LOGGER.warning("Cleared the license number of %d members sharing it with another member", cleared_count)
+		self._db.execute_sql('CREATE UNIQUE INDEX "member_license_nb" ON "member" ("license_nb") WHERE ("license_nb" <> \'\')')
+
+	def migrate_to_version_17(self):
+		self._db.create_tables((InventoryProgress, ))
+		inventory = Inventory.get_or_none(in_progress=True)
+		if inventory is None:
+			return
+		counts = (Item
+			.select(Value(inventory.id), Item.type, fn.COUNT(Item.id) - fn.COUNT(ItemState.id), fn.COUNT(ItemState.id))
+			.join(ItemState, JOIN.LEFT_OUTER, on=((ItemState.item_id == Item.id) & (ItemState.date == inventory.date)))
+			.where(
+				(Item.is_trashed == False)
+				& (Item.type.not_in((ITEM_TYPE_SECOND_STAGE, ITEM_TYPE_OCTOPUS, ITEM_TYPE_MANOMETER)))
+			)
+			.group_by(Item.type)
+		)
+		fields = [InventoryProgress.inventory, InventoryProgress.type, InventoryProgress.remaining_count, InventoryProgress.done_count]
+		_LOGGER.warning("Will count the items of the running inventory")
+		InventoryProgress.insert_from(counts, fields).execute()
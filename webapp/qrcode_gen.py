@@ -7,9 +7,18 @@ https://pillow.readthedocs.io/en/stable/reference/
 https://github.com/lincolnloop/python-qrcode
 
 """
+import json
 import logging
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
+from functools import lru_cache
+from hashlib import sha256
+from io import BytesIO
+from itertools import islice
+from os import cpu_count, makedirs, remove, replace, scandir, utime
 from os.path import join
+from xml.sax.saxutils import escape
 
 import qrcode
 from PIL import Image, ImageDraw, ImageFont
@@ -36,10 +45,21 @@ DEFAULT_CONFIG = {
 }
 
 
+@lru_cache(maxsize=None)
+def load_font(name, size):
+	try:
+		return ImageFont.truetype("%s.ttf" % name, size)
+	except IOError:
+		raise Exception("No font found")
+
+
 class ConverterException(Exception):
 	pass
 
 
+OUTPUT_FORMATS = ("png", "svg")
+
+
 class PageFullException(Exception):
 	pass
 
@@ -77,7 +97,37 @@ class ConverterMixin:
 		return round(size * self._dpi / ((4 * version + 17) *self.INCH))
 
 
-class Page(ConverterMixin):
+class FlowLayoutMixin:
+	"""
+	Places boxes from left to right in rows, from the top to the bottom of the area between coord_min and coord_max
+
+	"""
+
+	def __init__(self, coord_min, coord_max):
+		self._coord_min = coord_min
+		self._coord_max = coord_max
+		self._current_coord = copy(self._coord_min)
+		self._next_row_start = self._coord_min.y
+
+	def place(self, width, height):
+		if width > self._coord_max.x - self._coord_min.x:
+			raise ConverterException("Image '%s' is too wide for this page")
+		if height > self._coord_max.y - self._coord_min.y:
+			raise ConverterException("Image '%s' is too high for this page")
+		if self._current_coord.x + width > self._coord_max.x:
+			# go to the next line
+			_LOGGER.info("Row is full -> go to the next one")
+			self._current_coord.x = self._coord_min.x
+			self._current_coord.y = self._next_row_start
+			if self._current_coord.y + height > self._coord_max.y:
+				raise PageFullException()
+		coord = copy(self._current_coord)
+		self._current_coord.x += width
+		self._next_row_start = max(self._next_row_start, self._current_coord.y + height)
+		return coord
+
+
+class Page(ConverterMixin, FlowLayoutMixin):
 
 	def __init__(self, image_factory=Image, **config):
 		self._config = copy(DEFAULT_CONFIG)
@@ -91,30 +141,23 @@ class Page(ConverterMixin):
 		ConverterMixin.__init__(self, self._config['dpi'])
 
 		self._page = image_factory.new("RGB", (self.size_to_pixels(self._width), self.size_to_pixels(self._height)), (255, 255, 255))
-		self._coord_min = Point(self.size_to_pixels(self._margin_left), self.size_to_pixels(self._margin_top))
-		self._coord_max = Point(self.size_to_pixels(self._width - self._margin_right), self.size_to_pixels(self._height - self._margin_bottom))
-		self._current_coord = copy(self._coord_min)
-		self._next_row_start = self._coord_min.y
+		FlowLayoutMixin.__init__(self,
+			Point(self.size_to_pixels(self._margin_left), self.size_to_pixels(self._margin_top)),
+			Point(self.size_to_pixels(self._width - self._margin_right), self.size_to_pixels(self._height - self._margin_bottom)),
+		)
 
 	def add_image(self, img):
-		if img.width > self._coord_max.x - self._coord_min.x:
-			raise ConverterException("Image '%s' is too wide for this page")
-		if img.height > self._coord_max.y - self._coord_min.y:
-			raise ConverterException("Image '%s' is too high for this page")
-		if self._current_coord.x + img.width > self._coord_max.x:
-			# go to the next line
-			_LOGGER.info("Row is full -> go to the next one")
-			self._current_coord.x = self._coord_min.x
-			self._current_coord.y = self._next_row_start
-			if self._current_coord.y + img.height > self._coord_max.y:
-				raise PageFullException()
-		self._page.paste(img, (self._current_coord.x, self._current_coord.y))
-		self._current_coord.x += img.width
-		self._next_row_start = max(self._next_row_start, self._current_coord.y + img.height)
+		coord = self.place(img.width, img.height)
+		self._page.paste(img, (coord.x, coord.y))
 
 	def save(self, filepath):
 		self._page.save(filepath)
 
+	def to_bytes(self):
+		fobj = BytesIO()
+		self._page.save(fobj, format="PNG")
+		return fobj.getvalue()
+
 
 class QRCode(ConverterMixin):
 
@@ -131,10 +174,7 @@ class QRCode(ConverterMixin):
 		ConverterMixin.__init__(self, self._config['dpi'])
 		self._box_size = self.qrcode_dot_size_in_pixel(self._size, self._version)
 
-		try:
-			self._font = ImageFont.truetype("%s.ttf" % self.FONT_NAME, round(self._size * 2.33))
-		except IOError:
-			raise Exception("No font found")
+		self._font = load_font(self.FONT_NAME, round(self._size * 2.33))
 		_LOGGER.debug("Creating a QRcode of %smm with dots of %s pixels ", self._size, self._box_size)
 
 	def _generate_text_image(self, text):
@@ -183,33 +223,282 @@ class QRCode(ConverterMixin):
 		return qr_img
 
 
-def generate_qrcodes(dest_dir, filename, data_pairs, page_sizes=(500, 500), qrcode_size=28):
+VectorImage = namedtuple("VectorImage", ("width", "height", "content"))
+
+
+class VectorPage(FlowLayoutMixin):
 	"""
-	dest_dir is the directory in which the file(s) will be generated
-	filename is the basename of the generated file(s). It will be appended with -1, -2 and so on if not all QR codes can be put in one file
-	data_pairs is a list of (data embedded, text printed at the center of the image)
+	SVG page whose sizes are in millimeters, so its memory and file size do not depend on the dpi
 
 	"""
-	qr_codes = [QRCode(size=qrcode_size, padding=3).create_qr_code_image(data, text) for data, text in data_pairs]
-	qr_idx = 0
-	page_nb = 1
-	while "QR code to generate":
-		filepath = join(dest_dir, "%s%d.png" % (filename, page_nb))
-		_LOGGER.info("Generating QR codes for in '%s'", filepath)
-		page = Page(sizes=page_sizes, margins=(0, 0))
+
+	def __init__(self, **config):
+		self._config = copy(DEFAULT_CONFIG)
+		self._config.update(config)
+		self._width = self._config['page']['width']
+		self._height = self._config['page']['height']
+		FlowLayoutMixin.__init__(self,
+			Point(self._config['page']['margin_left'], self._config['page']['margin_top']),
+			Point(self._width - self._config['page']['margin_right'], self._height - self._config['page']['margin_bottom']),
+		)
+		self._contents = []
+
+	def add_image(self, img):
+		coord = self.place(img.width, img.height)
+		self._contents.append('<g transform="translate(%s %s)">%s</g>' % (_svg_number(coord.x), _svg_number(coord.y), img.content))
+
+	def to_svg(self):
+		return "".join((
+			'<svg xmlns="http://www.w3.org/2000/svg" width="%smm" height="%smm" viewBox="0 0 %s %s">' % (self._width, self._height, self._width, self._height),
+			'<rect width="100%" height="100%" fill="white"/>',
+			*self._contents,
+			"</svg>\n",
+		))
+
+	def save(self, filepath):
+		with open(filepath, 'w') as fobj:
+			fobj.write(self.to_svg())
+
+	def to_bytes(self):
+		return self.to_svg().encode()
+
+
+class VectorQRCode:
+	"""
+	Draws the QR code modules, the frame and the centered text as SVG elements sized in millimeters
+
+	"""
+
+	TEXT_SIZE_RATIO = 2.33 * ConverterMixin.INCH / DEFAULT_CONFIG['dpi']
+
+	def __init__(self, **config):
+		self._config = copy(DEFAULT_CONFIG)
+		self._config.update(config)
+		self._version = self._config['qrcode']['version']
+		self._size = self._config['qrcode']['size']
+		self._padding = self._config['qrcode']['padding']
+		self._border_width = self._config['qrcode']['border_width']
+		self._margin = self._config['qrcode']['margin']
+
+	def _generate_modules_path(self, data):
+		qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, version=self._version, border=0)
+		qr.add_data(data)
+		qr.make()
+		matrix = qr.get_matrix()
+		dot_size = self._size / len(matrix)
+		path = []
+		for y, row in enumerate(matrix):
+			x = 0
+			while x < len(row):
+				if not row[x]:
+					x += 1
+					continue
+				run_start = x
+				while x < len(row) and row[x]:
+					x += 1
+				path.append("M%s %sh%sv%sh-%sz" % tuple(_svg_number(n) for n in (
+					run_start * dot_size, y * dot_size, (x - run_start) * dot_size, dot_size, (x - run_start) * dot_size
+				)))
+		return "".join(path)
+
+	def create_qr_code_image(self, data, text):
+		offset = self._margin + self._border_width + self._padding
+		frame_offset = self._margin + self._border_width / 2
+		frame_size = self._size + 2 * self._padding + self._border_width
+		tile_size = self._size + 2 * offset
+		text_box = (self._size / 2, self._size / 3.5)
+		content = "".join((
+			'<rect x="%s" y="%s" width="%s" height="%s" fill="none" stroke="black" stroke-width="%s"/>' % tuple(
+				_svg_number(n) for n in (frame_offset, frame_offset, frame_size, frame_size, self._border_width)
+			),
+			'<path transform="translate(%s %s)" d="%s"/>' % (_svg_number(offset), _svg_number(offset), self._generate_modules_path(data)),
+			'<rect x="%s" y="%s" width="%s" height="%s" fill="white"/>' % tuple(_svg_number(n) for n in (
+				(tile_size - text_box[0]) / 2, (tile_size - text_box[1]) / 2, text_box[0], text_box[1]
+			)),
+			'<text x="%s" y="%s" font-family="DejaVu Sans Mono" font-weight="bold" font-size="%s" text-anchor="middle" dominant-baseline="central">%s</text>' % (
+				_svg_number(tile_size / 2), _svg_number(tile_size / 2), _svg_number(self._size * self.TEXT_SIZE_RATIO), escape(text)
+			),
+		))
+		return VectorImage(tile_size, tile_size, content)
+
+
+def _svg_number(number):
+	return ("%.3f" % number).rstrip("0").rstrip(".")
+
+
+# QRCode of the current worker process, see render_qr_code_images()
+_RENDERER = None
+
+
+def _init_renderer(config):
+	global _RENDERER
+	_RENDERER = QRCode(**config)
+
+
+def _render_qr_code_image(data_pair):
+	return _RENDERER.create_qr_code_image(*data_pair)
+
+
+class TileCache:
+	"""
+	Content addressed cache of the rendered QR code images, the least recently used files are evicted when
+	the total size exceeds max_bytes
+
+	"""
+
+	def __init__(self, directory, max_bytes=100 * 1024 * 1024):
+		self._directory = directory
+		self._max_bytes = max_bytes
+		makedirs(directory, exist_ok=True)
+
+	@staticmethod
+	def key(data, text, **config):
+		tile_config = copy(DEFAULT_CONFIG)
+		tile_config.update(config)
+		content = [data, text, tile_config['qrcode'], tile_config['dpi'], QRCode.FONT_NAME]
+		return sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+	def _filepath(self, key):
+		return join(self._directory, "%s.png" % key)
+
+	def __contains__(self, key):
+		try:
+			utime(self._filepath(key))
+		except FileNotFoundError:
+			return False
+		return True
+
+	def get(self, key):
+		try:
+			with Image.open(self._filepath(key)) as img:
+				img.load()
+				return img.copy()
+		except FileNotFoundError:
+			return None
+
+	def put(self, key, img):
+		filepath = self._filepath(key)
+		tmp_filepath = "%s.tmp" % filepath
+		img.save(tmp_filepath, format="PNG")
+		replace(tmp_filepath, filepath)
+
+	def evict(self):
+		entries = [entry for entry in scandir(self._directory) if entry.name.endswith(".png")]
+		stats = sorted(((entry.stat(), entry.path) for entry in entries), key=lambda stat_path: stat_path[0].st_mtime)
+		total_bytes = sum(stat.st_size for stat, _ in stats)
+		for stat, filepath in stats:
+			if total_bytes <= self._max_bytes:
+				break
+			_LOGGER.debug("Evicting QR code tile '%s'", filepath)
+			try:
+				remove(filepath)
+			except FileNotFoundError:
+				pass
+			total_bytes -= stat.st_size
+
+
+# rendered images waiting to be consumed are kept in memory, a few per worker are enough to keep them busy
+RENDERS_IN_FLIGHT_PER_WORKER = 2
+
+def _render_qr_code_images(data_pairs, workers, config):
+	workers = min(workers or cpu_count() or 1, len(data_pairs))
+	if workers <= 1:
+		renderer = QRCode(**config)
+		for data, text in data_pairs:
+			yield renderer.create_qr_code_image(data, text)
+		return
+	_LOGGER.info("Rendering %d QR codes with %d workers", len(data_pairs), workers)
+	data_pairs = iter(data_pairs)
+	with ProcessPoolExecutor(max_workers=workers, initializer=_init_renderer, initargs=(config, )) as executor:
+		renders = deque(executor.submit(_render_qr_code_image, data_pair) for data_pair in islice(data_pairs, RENDERS_IN_FLIGHT_PER_WORKER * workers))
+		while renders:
+			img = renders.popleft().result()
+			for data_pair in islice(data_pairs, 1):
+				renders.append(executor.submit(_render_qr_code_image, data_pair))
+			yield img
+
+
+def render_qr_code_images(data_pairs, workers=None, cache=None, **config):
+	"""
+	Yields the QR code images of the data_pairs in order. They are rendered by a pool of workers processes
+	which load the font and the configuration once. Only the images missing from the cache are rendered
+
+	"""
+	data_pairs = list(data_pairs)
+	if cache is None:
+		yield from _render_qr_code_images(data_pairs, workers, config)
+		return
+
+	keys = [TileCache.key(data, text, **config) for data, text in data_pairs]
+	hits = set(key for key in keys if key in cache)
+	misses = [data_pair for data_pair, key in zip(data_pairs, keys) if key not in hits]
+	_LOGGER.info("%d QR codes found in cache, %d to render", len(data_pairs) - len(misses), len(misses))
+	rendered = _render_qr_code_images(misses, workers, config)
+	for data_pair, key in zip(data_pairs, keys):
+		img = cache.get(key) if key in hits else None
+		if img is None:
+			if key in hits:
+				_LOGGER.warning("QR code tile '%s' has been evicted meanwhile", key)
+				img = QRCode(**config).create_qr_code_image(*data_pair)
+			else:
+				img = next(rendered)
+			cache.put(key, img)
+		yield img
+	cache.evict()
+
+
+def fill_pages(images, page_factory=Page):
+	"""
+	Yields the pages as soon as they are full, the last one may not be full
+
+	"""
+	page = page_factory()
+	for img in images:
 		try:
-			while qr_idx < len(qr_codes):
-				page.add_image(qr_codes[qr_idx])
-				qr_idx += 1
+			page.add_image(img)
 		except PageFullException:
 			_LOGGER.info("Page is full -> continue in a new one")
-			page.save(filepath)
-			page_nb += 1
-			continue
-		else:
-			_LOGGER.info("No more QR code to generate")
-			page.save(filepath)
-			break
+			yield page
+			page = page_factory()
+			page.add_image(img)
+	yield page
+
+
+def generate_qrcode_pages(data_pairs, page_sizes=(500, 500), qrcode_size=28, workers=None, cache=None, output_format="png"):
+	"""
+	Yields the pages of QR codes as soon as they are full
+	data_pairs is a list of (data embedded, text printed at the center of the image)
+	workers is the number of processes rendering the QR codes, defaults to the number of CPUs
+	cache is an optional TileCache of the already rendered QR codes
+	output_format is either "png" (bitmap pages at the configured dpi) or "svg" (vector pages)
+
+	"""
+	if output_format == "svg":
+		vector_qrcode = VectorQRCode(size=qrcode_size, padding=3)
+		qr_codes = (vector_qrcode.create_qr_code_image(data, text) for data, text in data_pairs)
+		page_factory = lambda: VectorPage(sizes=page_sizes, margins=(0, 0))
+	elif output_format == "png":
+		qr_codes = render_qr_code_images(data_pairs, workers=workers, cache=cache, size=qrcode_size, padding=3)
+		page_factory = lambda: Page(sizes=page_sizes, margins=(0, 0))
+	else:
+		raise ConverterException("'%s' is not a valid output format" % output_format)
+	yield from fill_pages(qr_codes, page_factory)
+
+
+def generate_qrcodes(dest_dir, filename, data_pairs, output_format="png", **kwargs):
+	"""
+	dest_dir is the directory in which the file(s) will be generated
+	filename is the basename of the generated file(s). It will be appended with -1, -2 and so on if not all QR codes can be put in one file
+	the other arguments are the ones of generate_qrcode_pages()
+
+	"""
+	filepaths = []
+	for page_nb, page in enumerate(generate_qrcode_pages(data_pairs, output_format=output_format, **kwargs), start=1):
+		filepath = join(dest_dir, "%s%d.%s" % (filename, page_nb, output_format))
+		_LOGGER.info("Saving QR codes page '%s'", filepath)
+		page.save(filepath)
+		filepaths.append(filepath)
+	return filepaths
 
 
 #pylint: disable=C0103
@@ -5,18 +5,27 @@
 import logging
 from collections import namedtuple
 from datetime import MINYEAR, date, datetime, timedelta
-from itertools import dropwhile, takewhile
 from os.path import splitext
 
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as _l
-from peewee import JOIN, SQL, Case, DoesNotExist, IntegrityError, ProgrammingError, fn
-from weblib.models import User
+from peewee import (
+	JOIN, SQL, Case, DataError, DoesNotExist, IntegrityError, ProgrammingError, Tuple, Value, ValuesList, fn
+)
+import psycopg2
+from playhouse.shortcuts import model_to_dict
+from weblib.models import User, flask_db
 from weblib.requests import TableRequestResult, request_table, translate_field, translate_row
 
-from webapp import CONFIG_REF_PREFIXES
-from webapp.items import ITEM_TYPE_MANOMETER, ITEM_TYPE_OCTOPUS, ITEM_TYPE_SECOND_STAGE, ITEM_USAGE_MAX
-from webapp.models import Borrow, Inventory, IsComposedOf, Item, ItemState, Member, Servicing
+from webapp.cache import InvalidationListener, ProcessCache, RequestCache
+from webapp.items import (
+	ITEM_TYPE_FIRST_STAGE, ITEM_TYPE_FIRST_STAGE_AUXILIARY, ITEM_TYPE_MANOMETER, ITEM_TYPE_OCTOPUS, ITEM_TYPE_SECOND_STAGE,
+	ITEM_USAGE_MAX
+)
+from webapp.models import (
+	Borrow, Inventory, InventoryProgress, IsComposedOf, Item, ItemCurrentState, ItemState, Member, Servicing
+)
+from webapp.scan import get_scan_decoder
 from webapp.tables import ITEMS_COLUMNS, MANDATORY_ITEMS_COLUMNS
 
 _LOGGER = logging.getLogger(__name__)
@@ -29,7 +38,55 @@ class InventoryException(Exception):
 	pass
 
 
-def create_item_state(**kwargs): ItemState.create(**kwargs)
+def create_item_state(**kwargs):
+	with flask_db.database.atomic():
+		ItemState.create(**kwargs)
+		refresh_items_current_state((kwargs['item_id'], ))
+		if get_running_inventory_date() is not None:
+			count_inventoried_items((kwargs['item_id'], ), kwargs['date'])
+	invalidate_items()
+
+
+def refresh_item_states(item_id):
+	"""
+	The generic CRUD pages write the states of an item by themselves: maintain after them what create_item_state()
+	maintains, the current state projection, the caches and the inventory counters
+
+	"""
+	with flask_db.database.atomic():
+		refresh_items_current_state((item_id, ))
+		refresh_inventory_progress()
+	invalidate_items()
+
+
+def create_items_states(items_ids, at_date, is_present=True, is_usable=True, batch_size=500):
+	"""
+	Record the same state at **at_date** for every item of **items_ids** with multi-rows inserts in one transaction.
+	The items which already have a state at this date are left as is.
+	Returns the ids of the items whose state has been recorded
+
+	"""
+	items_ids = list(dict.fromkeys(items_ids))
+	fields = [ItemState.item_id, ItemState.date, ItemState.is_present, ItemState.is_usable]
+	recorded_ids = []
+	with flask_db.database.atomic():
+		for i in range(0, len(items_ids), batch_size):
+			rows = [(item_id, at_date, is_present, is_usable) for item_id in items_ids[i:i + batch_size]]
+			query = (ItemState
+				.insert_many(rows, fields=fields)
+				.on_conflict(conflict_target=[ItemState.item_id, ItemState.date], action="IGNORE")
+				.returning(ItemState.item_id)
+				.tuples()
+			)
+			recorded_ids += [row[0] for row in query.execute()]
+		if recorded_ids:
+			refresh_items_current_state(recorded_ids)
+			if get_running_inventory_date() is not None:
+				count_inventoried_items(recorded_ids, at_date)
+	invalidate_items()
+	return recorded_ids
+
+
 def create_item_servicing(**kwargs): Servicing.create(**kwargs)
 def create_servicing(**kwargs): Servicing.create(**kwargs)
 def create_is_composed_of(**kwargs): IsComposedOf.create(**kwargs)
@@ -52,13 +109,34 @@ def create_item(**kwargs):
 	for row in query:
 		raise IntegrityError(f"An item of the type '{item_type}' already exists with the same reference '{item_reference}'")
 	Item.create(**kwargs)
+	invalidate_items()
+	refresh_inventory_progress()
 
 
 def get_items(item_type, include_trashed=False, trashed_only=False, usable_only=False):
+	"""
+	Table of the items of the type **item_type** with their current state and whether they have been serviced
+	during the last SERVICING_PERIODICITY, all in a single query whatever the states history length.
+
+	"""
 	#assert not (usable_only and (include_trashed or trashed_only))
 	columns = MANDATORY_ITEMS_COLUMNS + ITEMS_COLUMNS[item_type]
+	servicing = (Servicing
+		.select()
+		.where(
+			(Servicing.item_id == Item.id)
+			& (Servicing.date > datetime.now() - SERVICING_PERIODICITY)
+		)
+	)
 	query = (Item
-		.select(Item.id, *columns)
+		.select(
+			Item.id,
+			*columns,
+			fn.COALESCE(ItemCurrentState.is_present, True),
+			fn.COALESCE(ItemCurrentState.is_usable, True),
+			fn.EXISTS(servicing),
+		)
+		.join(ItemCurrentState, JOIN.LEFT_OUTER, on=(ItemCurrentState.item_id == Item.id))
 		.where(
 			(Item.type == item_type)
 			& ((Item.is_trashed == trashed_only) if not include_trashed else True)
@@ -67,41 +145,36 @@ def get_items(item_type, include_trashed=False, trashed_only=False, usable_only=
 		.tuples()
 	)
 
-	serviced_items = get_serviced_items(item_type)
-	query_tuples = []
-	for row in query:
-		query_tuples.append(
-			row
-			+ get_items_last_state(item_type).get(row[0], (True, True))
-			+ (row[0] in serviced_items, )
-		)
-	query_tuples = tuple(query_tuples)
-
 	class ServicingStub:
 		column_name = "is_serviced"
 		i18n = _("Is serviced")
 
-	return TableRequestResult(columns + (ItemState.is_present, ItemState.is_usable, ServicingStub), query_tuples)
+	return TableRequestResult(columns + (ItemState.is_present, ItemState.is_usable, ServicingStub), query)
+
+
+ROWS_CACHE = RequestCache("rows")
+
+def get_row(model, row_id):
+	"""
+	Row **row_id** of **model**, memoized for the duration of the current request as the views look the same item or
+	member up several times. Raises DoesNotExist if there is no such row
+
+	"""
+	if model is Item:
+		loader = lambda: ITEMS_CACHE.get(str(row_id), lambda: Item.get_by_id(row_id))
+	else:
+		loader = lambda: model.get_by_id(row_id)
+	return ROWS_CACHE.get((model, str(row_id)), loader)
 
 
 def get_item(item_id, include_trashed=False):
-	item_type = (Item
-		.select(Item.type)
-		.where(Item.id == item_id)
-	)[0].type
-	columns = MANDATORY_ITEMS_COLUMNS + ITEMS_COLUMNS[item_type]
-	query = (Item
-		.select(*columns)
-		.where(
-			(Item.id == item_id)
-			& ((Item.is_trashed == False) if not include_trashed else True)
-		)
-		.dicts()
-	)
 	try:
-		return query[0]
-	except IndexError:
+		item = get_row(Item, item_id)
+	except DoesNotExist:
 		return {}
+	if item.is_trashed and not include_trashed:
+		return {}
+	return {column.name: getattr(item, column.name) for column in MANDATORY_ITEMS_COLUMNS + ITEMS_COLUMNS[item.type]}
 
 
 def get_item_references(item_type, available_items_only=False):
@@ -115,18 +188,18 @@ def get_item_references(item_type, available_items_only=False):
 		)
 		query = (Item
 			.select(Item.id, Item.reference)
-			.join(Borrow, JOIN.LEFT_OUTER, on=(Borrow.item_id == Item.id))
+			.join(ItemCurrentState, JOIN.LEFT_OUTER, on=(ItemCurrentState.item_id == Item.id))
 			.where(
 				(Item.type == item_type)
 				& (~fn.EXISTS(subq))
 				& (Item.usage_counter < ITEM_USAGE_MAX)
 				& (Item.is_servicing == False)
 				& (Item.is_trashed == False)
+				& (fn.COALESCE(ItemCurrentState.is_present & ItemCurrentState.is_usable, True))
 			)
 			.order_by(Item.reference)
 		)
-		last_states = get_items_last_state(item_type)
-		return tuple(sorted([(i.id, i.reference) for i in set(i for i in query) if all(last_states.get(i.id, (True, )))], key=lambda t: t[1]))
+		return tuple([(row.id, row.reference) for row in query])
 	else:
 		query = (Item
 			.select(Item.id, Item.reference)
@@ -138,102 +211,200 @@ def get_item_references(item_type, available_items_only=False):
 		return tuple([(row.id, row.reference) for row in query])
 
 
+AVAILABLE_ITEMS_CACHE = ProcessCache("available items")
+
+def get_available_item_references(item_type):
+	"""
+	Same as get_item_references(item_type, available_items_only=True) but served from a per type cache which is
+	dropped by invalidate_items() on every event that can change an item's availability.
+
+	"""
+	return AVAILABLE_ITEMS_CACHE.get(item_type, lambda: get_item_references(item_type, available_items_only=True))
+
+
+# Item rows by id and ids of the untrashed items by (type, reference)
+ITEMS_CACHE = ProcessCache("items")
+# running and latest inventories dates, see get_running_inventory_date()
+INVENTORY_CAMPAIGN_CACHE = ProcessCache("inventory campaign")
+CACHES_LISTENER = InvalidationListener("jellyfish_caches", (ITEMS_CACHE, AVAILABLE_ITEMS_CACHE, INVENTORY_CAMPAIGN_CACHE))
+
+def listen_to_changes():
+	"""
+	Invalidate the process caches when another process modifies the items or the inventories
+
+	"""
+	database = flask_db.database
+	CACHES_LISTENER.start(lambda: psycopg2.connect(dbname=database.database, **database.connect_params))
+
+
+def invalidate_items():
+	"""
+	Every write to the items ends here, once its transaction is committed. When the process caches are shared,
+	the other processes are notified with one more statement
+
+	"""
+	AVAILABLE_ITEMS_CACHE.invalidate()
+	ITEMS_CACHE.invalidate()
+	ROWS_CACHE.invalidate()
+	CACHES_LISTENER.notify(flask_db.database)
+
+
 def get_item_id(item_type, reference):
-	try:
-		return Item.get_or_none(type=item_type, reference=reference, is_trashed=False).id
-	except AttributeError:
-		return None
+	def load():
+		item = Item.get_or_none(type=item_type, reference=reference, is_trashed=False)
+		return item.id if item else None
+
+	return ITEMS_CACHE.get((item_type, str(reference)), load)
+
+
+def get_items_names(items_ids=(), types_references=()):
+	"""
+	Resolve in one query the given item ids and (type, reference) couples of untrashed items.
+	Returns a dict of the found items {id: (type, reference)}
+
+	"""
+	clause = Item.id.in_(tuple(items_ids))
+	if types_references:
+		clause |= Tuple(Item.type, Item.reference).in_(tuple(types_references))
+	query = (Item
+		.select(Item.id, Item.type, Item.reference)
+		.where(clause & (Item.is_trashed == False))
+		.tuples()
+	)
+	return {row[0]: (row[1], row[2]) for row in query}
 
 
 def get_item_type(item_id):
-	return Item.get_by_id(item_id).type
+	return get_row(Item, item_id).type
 
 
 def get_item_reference(item_id):
-	return Item.get_by_id(item_id).reference
+	return get_row(Item, item_id).reference
+
+
+def format_item_name(item_type, reference):
+	return f"{Item.type.lut[item_type]} {reference}"
 
 
 def get_item_type_and_reference(item_id):
-	item = Item.get_or_none(id=item_id)
-	return f"{Item.type.lut[item.type]} {item.reference}"
+	item = get_row(Item, item_id)
+	return format_item_name(item.type, item.reference)
+
+
+REGULATOR_PARTS_TYPES = (ITEM_TYPE_SECOND_STAGE, ITEM_TYPE_OCTOPUS, ITEM_TYPE_MANOMETER)
+
+def is_current_composition(at_date=None):
+	"""
+	Predicate matching the IsComposedOf rows in effect at **at_date** (at the latest known date if None), i.e. the
+	latest row of each child. It is backed by the (child_id, at_date) index.
+
+	"""
+	LATER = IsComposedOf.alias()
+	subq = (LATER
+		.select()
+		.where(
+			(LATER.child_id == IsComposedOf.child_id)
+			& (
+				(LATER.at_date > IsComposedOf.at_date)
+				| ((LATER.at_date == IsComposedOf.at_date) & (LATER.id > IsComposedOf.id))
+			)
+		)
+	)
+	if at_date is None:
+		return ~fn.EXISTS(subq)
+	return (IsComposedOf.at_date <= at_date) & ~fn.EXISTS(subq.where(LATER.at_date <= at_date))
 
 
-def get_regulators(is_auxiliary=False):
+def get_regulator_composition(regulator_id, at_date=None):
+	""" Ids of the parts mounted on the regulator **regulator_id** at **at_date** (currently if None) """
+	query = (IsComposedOf
+		.select(IsComposedOf.child_id)
+		.where(
+			(IsComposedOf.parent_id == regulator_id)
+			& is_current_composition(at_date)
+		)
+		.order_by(IsComposedOf.child_id)
+		.tuples()
+	)
+	return tuple([row[0] for row in query])
+
+
+def get_part_parent(part_id, at_date=None):
+	""" Id of the regulator the part **part_id** is mounted on at **at_date** (currently if None) """
+	query = (IsComposedOf
+		.select(IsComposedOf.parent_id)
+		.where(
+			(IsComposedOf.child_id == part_id)
+			& ((IsComposedOf.at_date <= at_date) if at_date is not None else True)
+		)
+		.order_by(IsComposedOf.at_date.desc(), IsComposedOf.id.desc())
+		.limit(1)
+	)
+	return query.scalar()
+
+
+def get_regulators(is_auxiliary=False, at_date=None):
+	"""
+	Main (or auxiliary) regulators with the parts mounted on them at **at_date** (currently if None), and the parts
+	that have never been mounted on a regulator. Each of the three lists is loaded by a single query.
+
+	"""
 	columns = (Item.type, Item.reference, Item.brand, Item.model, Item.serial_nb)
 	header = tuple(str(getattr(col, 'i18n')) for col in columns)
 	translatable_columns = ("type", "reference")
+	first_stage_type = ITEM_TYPE_FIRST_STAGE_AUXILIARY if is_auxiliary else ITEM_TYPE_FIRST_STAGE
 
-	first_stages_ids = (Item
-		.select(Item.id)
-		.where(Item.type == ("first_stage_auxiliary" if is_auxiliary else "first_stage"))
+	first_stages = (Item
+		.select(Item.id, *columns)
+		.where(Item.type == first_stage_type)
 		.order_by(Item.reference)
+		.dicts()
 	)
 
-	regulators = []
-	children_with_parent = []
-	for first_stage_id in first_stages_ids:
-		first_stage = (Item
-			.select(Item.id, *columns)
-			.where(Item.id == first_stage_id)
-			.dicts()
-		)[0]
-
-		ALIAS = IsComposedOf.alias()
-		parts = (IsComposedOf
-			.select(ALIAS.parent_id, ALIAS.child_id)
-			.join(ALIAS, JOIN.LEFT_OUTER, on=(IsComposedOf.child_id == ALIAS.child_id))
-			.where(IsComposedOf.parent_id == first_stage_id)
-			.order_by(ALIAS.at_date)
-			.tuples()
+	PARENT = Item.alias()
+	parts = (IsComposedOf
+		.select(IsComposedOf.parent_id, Item.id, *columns)
+		.join(Item, on=(IsComposedOf.child_id == Item.id))
+		.switch(IsComposedOf)
+		.join(PARENT, on=(IsComposedOf.parent_id == PARENT.id))
+		.where(
+			(PARENT.type == first_stage_type)
+			& is_current_composition(at_date)
 		)
+		.order_by(Item.id)
+		.tuples()
+	)
+	children = {}
+	for parent_id, *part in parts:
+		children.setdefault(parent_id, []).append(translate_row(part, model_fields=(Item.id, *columns), internationalizable_fields=translatable_columns))
 
-		children = set()
-		for parent_id, child_id in parts:
-			if parent_id == first_stage_id.id:
-				children.add(child_id)
-			else:
-				try:
-					children.remove(child_id)
-				except:
-					pass
-		children = sorted(list(children))
-		children_with_parent.extend(children)
-
-		parts = []
-		for part_id in children:
-			part = (Item
-				.select(Item.id, *columns)
-				.where(Item.id == part_id)
-				.tuples()
-			)[0]
-			parts.append(translate_row(part, model_fields=(Item.id, *columns), internationalizable_fields=translatable_columns)) #(part[0], ) + translate_row(part[1:]))
-
-		first_stage['children'] = tuple(parts)
-		Row = namedtuple("Row", ("id", "type", "reference", "brand", "model", "serial_nb", "children"))
-		row = Row(**first_stage)
-		regulators.append(row)
-
-	subq = IsComposedOf.select().where(IsComposedOf.child_id == Item.id)
-	regulator_parts = (Item
-		.select(Item.id)
+	subq = (IsComposedOf
+		.select()
 		.where(
-			(Item.type.in_(['second_stage', 'octopus', 'manometer']))
-			& (~fn.EXISTS(subq))
+			(IsComposedOf.child_id == Item.id)
+			& ((IsComposedOf.at_date <= at_date) if at_date is not None else True)
 		)
 	)
-	regulator_parts = set([row.id for row in regulator_parts])
-	orphans_ids = regulator_parts - set(children_with_parent)
-
 	orphans = (Item
 		.select(Item.id, *columns)
-		.where(Item.id.in_(orphans_ids))
+		.where(
+			(Item.type.in_(REGULATOR_PARTS_TYPES))
+			& (~fn.EXISTS(subq))
+		)
+		.order_by(Item.id)
 		.tuples()
 	)
 
+	Row = namedtuple("Row", ("id", "type", "reference", "brand", "model", "serial_nb", "children"))
+	regulators = []
+	for first_stage in first_stages:
+		first_stage['children'] = tuple(children.get(first_stage['id'], ()))
+		regulators.append(Row(**first_stage))
+
 	return {
 		'header': header,
 		'rows': tuple(regulators),
-		'orphans': tuple([(i[0], *translate_row(i[1:])) for i in orphans])
+		'orphans': tuple([(row[0], *translate_row(row[1:])) for row in orphans]),
 	}
 
 
@@ -241,12 +412,23 @@ def delete_item(item_id):
 	query = Item.delete().where(Item.id == item_id)
 	if query.execute() != 1:
 		raise DatabaseException("Could not delete item '%s'" % item_id)
+	invalidate_items()
+	refresh_inventory_progress()
 
 
 def trash_item(item_id):
 	query = Item.update({Item.is_trashed: True}).where(Item.id == item_id)
 	if query.execute() != 1:
 		raise DatabaseException("Could not trash item '%s'" % item_id)
+	invalidate_items()
+	refresh_inventory_progress()
+
+
+def update_item(item_id, **kwargs):
+	query = Item.update(kwargs).where(Item.id == item_id)
+	if query.execute() != 1:
+		raise DatabaseException("Could not update item '%s'" % item_id)
+	invalidate_items()
 
 
 def untrash_item(item_id):
@@ -258,6 +440,8 @@ def untrash_item(item_id):
 	query = Item.update({Item.is_trashed: False}).where(Item.id == item_id)
 	if query.execute() != 1:
 		raise DatabaseException("Could not untrash item '%s'" % item_id)
+	invalidate_items()
+	refresh_inventory_progress()
 
 
 
@@ -266,15 +450,12 @@ def untrash_item(item_id):
 ################################################## Members #############################################################
 ########################################################################################################################
 def get_member(row_id):
-	query = (Member
-		.select()
-		.where(Member.id == row_id)
-		.dicts()
-	)
-	return query[0]
+	return model_to_dict(get_row(Member, row_id))
 
 
 def get_member_id(license_nb):
+	if not license_nb:
+		return None
 	try:
 		return Member.get(Member.license_nb == license_nb).id
 	except DoesNotExist:
@@ -295,12 +476,77 @@ def get_members_fullnames(with_guarantee_only=False):
 	return tuple([(m.id, "%s %s" % (m.last_name, m.first_name)) for m in query])
 
 
+def sync_members(members, batch_size=1000):
+	"""
+	Synchronize the Member table with the given members (dicts of last_name, first_name, license_nb) in one
+	transaction. They are matched by license number, or by name for the ones without a license, and only the
+	differences are written. The members which are not given are removed unless they borrowed an item.
+	Returns the counts of inserted, updated, unchanged and removed members
+
+	"""
+	counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+	query = Member.select(Member.id, Member.last_name, Member.first_name, Member.license_nb).tuples()
+	known_members = {row[0]: row[1:] for row in query}
+	by_license = {license_nb: member_id for member_id, (_, _, license_nb) in known_members.items() if license_nb}
+	by_name = {(last_name, first_name): member_id for member_id, (last_name, first_name, _) in known_members.items()}
+
+	to_insert = []
+	to_update = []
+	matched_ids = set()
+	seen_licenses = set()
+	seen_names = set()
+	for member in members:
+		license_nb = member['license_nb'] or None
+		name = (member['last_name'], member['first_name'])
+		if license_nb in seen_licenses or name in seen_names:
+			_LOGGER.warning("Member '%s %s' is imported twice -> ignored", *name)
+			continue
+		if license_nb:
+			seen_licenses.add(license_nb)
+		seen_names.add(name)
+
+		member_id = by_license.get(license_nb)
+		if member_id is None or member_id in matched_ids:
+			member_id = by_name.get(name)
+		if member_id is None or member_id in matched_ids:
+			to_insert.append((*name, license_nb))
+		elif known_members[member_id] != (*name, license_nb):
+			matched_ids.add(member_id)
+			to_update.append((member_id, *name, license_nb))
+		else:
+			matched_ids.add(member_id)
+			counts['unchanged'] += 1
+	removed_ids = set(known_members) - matched_ids
+
+	with flask_db.database.atomic():
+		if removed_ids:
+			borrowers = Borrow.select(Borrow.member_id).where(Borrow.member_id.in_(tuple(removed_ids)) & (Borrow.to_datetime == None))
+			removed_ids -= set(row[0] for row in borrowers.tuples())
+		if removed_ids:
+			counts['removed'] = Member.delete().where(Member.id.in_(tuple(removed_ids))).execute()
+		for i in range(0, len(to_update), batch_size):
+			values = ValuesList(to_update[i:i + batch_size], columns=("id", "last_name", "first_name", "license_nb"), alias="v")
+			query = (Member
+				.update({Member.last_name: values.c.last_name, Member.first_name: values.c.first_name, Member.license_nb: values.c.license_nb})
+				.from_(values)
+				.where(Member.id == values.c.id)
+			)
+			counts['updated'] += query.execute()
+		for i in range(0, len(to_insert), batch_size):
+			query = Member.insert_many(to_insert[i:i + batch_size], fields=(Member.last_name, Member.first_name, Member.license_nb))
+			counts['inserted'] += query.as_rowcount().execute()
+	ROWS_CACHE.invalidate()
+	_LOGGER.info("Members synchronized: %(inserted)d inserted, %(updated)d updated, %(unchanged)d unchanged, %(removed)d removed", counts)
+	return counts
+
+
 def delete_all_members():
 	members_count = Member.select().count()
 	_LOGGER.warning("Will delete the %d members...", members_count)
 	query = Member.delete()
 	if query.execute() != members_count:
 		raise DatabaseException("Could not flush members table")
+	ROWS_CACHE.invalidate()
 
 
 
@@ -309,21 +555,67 @@ def delete_all_members():
 #################################################### Loans #############################################################
 ########################################################################################################################
 def borrow_item(item_id, user_id, member_id, at_datetime=None, usage_counter=0):
-	if is_item_borrowed(item_id):
-		raise IntegrityError("Item already borrowed")
-	Borrow.create(item=item_id, user=user_id, member=member_id, from_datetime=at_datetime, usage_counter=usage_counter)
-	current_counter = Item.select(Item.usage_counter).where(Item.id == item_id)[0].usage_counter
-	query = Item.update({Item.usage_counter: current_counter + usage_counter}).where(Item.id == item_id)
+	"""
+	Borrow an item in two statements, plus the notification of the other processes when they listen: the usage
+	counter update locks the item row, so a concurrent borrow of the same item waits for this transaction and then
+	sees its open loan in the insert
+
+	"""
+	with flask_db.database.atomic():
+		_borrow_item(item_id, user_id, member_id, at_datetime, usage_counter)
+	invalidate_items()
+
+
+def borrow_items(items_ids, user_id, member_id, at_datetime=None, usage_counter=0):
+	"""
+	Borrow several items in one transaction, each one in its own savepoint so that a refused item does not cancel
+	the others. Returns, in the order of **items_ids**, the exception raised for each item or None when it has been
+	borrowed: an item given twice is refused the second time
+
+	"""
+	errors = []
+	with flask_db.database.atomic():
+		for item_id in items_ids:
+			try:
+				with flask_db.database.atomic():
+					_borrow_item(item_id, user_id, member_id, at_datetime, usage_counter)
+			except (IntegrityError, DataError, DatabaseException) as error:
+				errors.append(error)
+			else:
+				errors.append(None)
+	invalidate_items()
+	return errors
+
+
+def _borrow_item(item_id, user_id, member_id, at_datetime, usage_counter):
+	open_borrow = Borrow.select(Borrow.id).where((Borrow.item_id == item_id) & (Borrow.to_datetime == None))
+	loan = (Item
+		.select(
+			Item.id,
+			Value(Borrow.user.db_value(user_id)),
+			Value(Borrow.member.db_value(member_id)),
+			Value(at_datetime),
+			Value(usage_counter),
+		)
+		.where((Item.id == item_id) & ~fn.EXISTS(open_borrow))
+	)
+	query = Item.update({Item.usage_counter: Item.usage_counter + usage_counter}).where(Item.id == item_id)
 	if query.execute() != 1:
 		raise DatabaseException("Could not update usage_counter for item '%s'" % item_id)
+	query = Borrow.insert_from(
+		loan,
+		(Borrow.item, Borrow.user, Borrow.member, Borrow.from_datetime, Borrow.usage_counter)
+	).returning(Borrow.id)
+	if not tuple(query.execute()):
+		raise IntegrityError("Item already borrowed")
 
 
 def is_item_borrowed(item_id):
 	query = (Borrow
-		.select()
+		.select(Borrow.id)
 		.where((Borrow.item_id == item_id) & (Borrow.to_datetime == None))
 	)
-	return any([True for row in query])
+	return query.exists()
 
 
 def get_borrowed_items():
@@ -348,6 +640,7 @@ def give_back_item(item_id, at_datetime, usage_counter=0):
 	query = Borrow.update(update_dict).where((Borrow.item_id == item_id) & (Borrow.to_datetime == None))
 	if query.execute() != 1:
 		raise DatabaseException("Could not give back item '%s'" % item_id)
+	invalidate_items()
 
 
 def get_loans():
@@ -380,9 +673,14 @@ def get_every_loans():
 
 
 def get_type_and_id(qrcode):
-	reference = "".join(dropwhile(lambda c: c.isalpha(), qrcode))
-	prefix = "".join(takewhile(lambda c: c.isalpha(), qrcode))
-	item_type = [t for t, p in CONFIG_REF_PREFIXES.items() if p == prefix][0]
+	"""
+	Returns the type and the id of the item of the given code (like 'S1'), None if there is no such item
+
+	"""
+	type_and_reference = get_scan_decoder().split_code(qrcode)
+	if type_and_reference is None:
+		return None
+	item_type, reference = type_and_reference
 
 	query = (Item
 		.select(Item.id)
@@ -391,10 +689,10 @@ def get_type_and_id(qrcode):
 			& (Item.reference == reference)
 		)
 	)
-
-	item_type = item_type
-
-	return (item_type, query[0].id)
+	item_id = query.scalar()
+	if item_id is None:
+		return None
+	return (item_type, item_id)
 
 
 
@@ -430,12 +728,14 @@ def service(items_ids):
 	query = Item.update({Item.is_servicing: True}).where(Item.id.in_(items_ids))
 	if query.execute() != len(items_ids):
 		raise DatabaseException("Could not update is_servicing for items '%s'" % items_ids)
+	invalidate_items()
 
 
 def unservice(item_id):
 	query = Item.update({Item.is_servicing: False, Item.usage_counter: 0}).where(Item.id == item_id)
 	if query.execute() != 1:
 		raise DatabaseException("Could not set is_servicing to False for item '%s'" % item_id)
+	invalidate_items()
 
 
 def get_servicing_files():
@@ -493,33 +793,42 @@ def get_item_states_dates():
 
 
 def get_items_last_state(item_type):
-	query = (ItemState
-		.select(ItemState.date, ItemState.is_present, ItemState.is_usable, Item.id)
+	query = (ItemCurrentState
+		.select(ItemCurrentState.item_id, ItemCurrentState.is_present, ItemCurrentState.is_usable)
 		.join(Item)
 		.where(Item.type == item_type)
-		.dicts()
+		.tuples()
 	)
-	min_date = date(MINYEAR, 1, 1)
-	ret = {}
-	for row in query:
-		if ret.get('date', min_date) < row['date']:
-			ret[row['id']] = (row['is_present'], row['is_usable'])
-	return ret
+	return {item_id: (is_present, is_usable) for item_id, is_present, is_usable in query}
 
 
-SERVICING_PERIODICITY = timedelta(days=365)
+def refresh_items_current_state(items_ids=None):
+	"""
+	Recompute the ItemCurrentState projection of the items **items_ids** (of every item if None) from their ItemState
+	history. This must be called after every write to the ItemState table.
 
-def get_serviced_items(item_type):
-	valid_if_after = datetime.now() - SERVICING_PERIODICITY
-	query = (Item
-		.select(Item.id, Servicing.date)
-		.join(Servicing)
-		.where(
-			(Item.type == item_type)
-			& (Servicing.date > valid_if_after)
-		)
+	"""
+	last_states = (ItemState
+		.select(ItemState.item_id, ItemState.date, ItemState.is_present, ItemState.is_usable)
+		.order_by(ItemState.item_id, ItemState.date.desc())
+		.distinct(ItemState.item_id)
+	)
+	subq = ItemState.select().where(ItemState.item_id == ItemCurrentState.item_id)
+	obsolete_states = ItemCurrentState.delete().where(~fn.EXISTS(subq))
+	if items_ids is not None:
+		last_states = last_states.where(ItemState.item_id.in_(items_ids))
+		obsolete_states = obsolete_states.where(ItemCurrentState.item_id.in_(items_ids))
+
+	fields = [ItemCurrentState.item_id, ItemCurrentState.date, ItemCurrentState.is_present, ItemCurrentState.is_usable]
+	query = (ItemCurrentState
+		.insert_from(last_states, fields)
+		.on_conflict(conflict_target=[ItemCurrentState.item_id], preserve=fields[1:])
 	)
-	return set(row.id for row in query)
+	query.execute()
+	obsolete_states.execute()
+
+
+SERVICING_PERIODICITY = timedelta(days=365)
 
 
 
@@ -530,7 +839,10 @@ def get_serviced_items(item_type):
 def create_inventory(**kwargs):
 	if get_running_inventory_date():
 		raise InventoryException("Can not create an inventory when there already is a running one")
-	Inventory.create(**kwargs)
+	with flask_db.database.atomic():
+		inventory = Inventory.create(**kwargs)
+		refresh_inventory_progress(inventory)
+	invalidate_inventory_campaign()
 
 
 def get_inventories():
@@ -544,7 +856,8 @@ def get_inventories():
 
 
 def get_latest_inventory_date():
-	return Inventory.select(fn.MAX(Inventory.date))[0].max or date.min
+	load = lambda: Inventory.select(fn.MAX(Inventory.date))[0].max or date.min
+	return INVENTORY_CAMPAIGN_CACHE.get('latest', load)
 
 
 def get_inventory(date):
@@ -556,22 +869,154 @@ def get_inventory_date(inventory_id):
 
 
 def get_running_inventory_date():
+	"""
+	Date of the running inventory or None, it is read by every gear and inventory request but changes a few times a
+	year: it is served from the process cache until invalidate_inventory_campaign()
+
+	"""
+	def load():
+		inventory = Inventory.get_or_none(in_progress=True)
+		return inventory.date if inventory else None
+
 	try:
-		return Inventory.get(in_progress=True).date
-	except (DoesNotExist, ProgrammingError):
+		return INVENTORY_CAMPAIGN_CACHE.get('running', load)
+	except ProgrammingError:
 		return None
 
 
+def invalidate_inventory_campaign():
+	INVENTORY_CAMPAIGN_CACHE.invalidate()
+	CACHES_LISTENER.notify(flask_db.database)
+
+
 def stop_inventory_campaign():
 	query = Inventory.update({Inventory.in_progress: False}).where(Inventory.in_progress == True)
-	if query.execute() != 1:
+	updated_count = query.execute()
+	invalidate_inventory_campaign()
+	if updated_count != 1:
 		raise DatabaseException("Error while stopping current inventory campaign")
 
 
 def restart_inventory_campaign(inventory_id):
 	query = Inventory.update({Inventory.in_progress: True}).where(Inventory.id == inventory_id)
-	if query.execute() != 1:
+	updated_count = query.execute()
+	invalidate_inventory_campaign()
+	if updated_count != 1:
 		raise DatabaseException("Error while restarting inventory campaign id '%s'", inventory_id)
+	# items may have been added, trashed or inventoried since the campaign was stopped
+	refresh_inventory_progress()
+
+
+# the regulators parts are inventoried with their regulator
+INVENTORIED_ITEMS = (Item.is_trashed == False) & (Item.type.not_in(REGULATOR_PARTS_TYPES))
+
+def refresh_inventory_progress(inventory=None):
+	"""
+	Recount the remaining and done items of each type of the **inventory** (of the running one if None) from the
+	items and their states. The counters are then kept up to date by count_inventoried_items()
+
+	"""
+	if inventory is None:
+		running_inventory_date = get_running_inventory_date()
+		if running_inventory_date is None:
+			return
+		inventory = Inventory.get(date=running_inventory_date)
+	counts = (Item
+		.select(Value(inventory.id), Item.type, fn.COUNT(Item.id) - fn.COUNT(ItemState.id), fn.COUNT(ItemState.id))
+		.join(ItemState, JOIN.LEFT_OUTER, on=((ItemState.item_id == Item.id) & (ItemState.date == inventory.date)))
+		.where(INVENTORIED_ITEMS)
+		.group_by(Item.type)
+	)
+	fields = [InventoryProgress.inventory, InventoryProgress.type, InventoryProgress.remaining_count, InventoryProgress.done_count]
+	with flask_db.database.atomic():
+		InventoryProgress.delete().where(InventoryProgress.inventory == inventory.id).execute()
+		InventoryProgress.insert_from(counts, fields).execute()
+
+
+def count_inventoried_items(items_ids, at_date):
+	"""
+	Move the items from the remaining to the done ones if their states were recorded during the running inventory
+
+	"""
+	running_inventory = Inventory.select(Inventory.id).where((Inventory.date == at_date) & (Inventory.in_progress == True))
+	counts = (Item
+		.select(Item.type, fn.COUNT(Item.id).alias('count'))
+		.where(Item.id.in_(tuple(items_ids)) & INVENTORIED_ITEMS)
+		.group_by(Item.type)
+		.alias('counts')
+	)
+	query = (InventoryProgress
+		.update({
+			InventoryProgress.remaining_count: InventoryProgress.remaining_count - counts.c.count,
+			InventoryProgress.done_count: InventoryProgress.done_count + counts.c.count,
+		})
+		.from_(counts)
+		.where(
+			(InventoryProgress.inventory.in_(running_inventory))
+			& (InventoryProgress.type == counts.c.type)
+		)
+	)
+	query.execute()
+
+
+def carry_forward_states(item_type=None):
+	"""
+	Record for every item (of the type **item_type** if given) not inventoried yet during the running inventory the
+	state it had during the previous inventory, price and comment included, with a single INSERT ... SELECT.
+	Returns the ids of the items whose state has been recorded
+
+	"""
+	running_inventory_date = get_running_inventory_date()
+	if running_inventory_date is None:
+		raise InventoryException("There is no running inventory")
+	previous_inventory_date = (Inventory
+		.select(fn.MAX(Inventory.date))
+		.where(Inventory.date < running_inventory_date)
+		.scalar()
+	)
+	if previous_inventory_date is None:
+		return []
+
+	PREVIOUS = ItemState.alias()
+	previous_states = (PREVIOUS
+		.select(PREVIOUS.item_id, Value(running_inventory_date), PREVIOUS.is_present, PREVIOUS.is_usable, PREVIOUS.price, PREVIOUS.comment)
+		.join(Item, on=(Item.id == PREVIOUS.item_id))
+		.where(
+			(PREVIOUS.date == previous_inventory_date)
+			& (Item.is_trashed == False)
+			& ((Item.type == item_type) if item_type is not None else True)
+		)
+	)
+	fields = [ItemState.item_id, ItemState.date, ItemState.is_present, ItemState.is_usable, ItemState.price, ItemState.comment]
+	with flask_db.database.atomic():
+		query = (ItemState
+			.insert_from(previous_states, fields)
+			.on_conflict(conflict_target=[ItemState.item_id, ItemState.date], action="IGNORE")
+			.returning(ItemState.item_id)
+			.tuples()
+		)
+		recorded_ids = [row[0] for row in query.execute()]
+		if recorded_ids:
+			refresh_items_current_state(recorded_ids)
+			count_inventoried_items(recorded_ids, running_inventory_date)
+	invalidate_items()
+	_LOGGER.info("Carried forward the states of %d items from the %s inventory", len(recorded_ids), previous_inventory_date)
+	return recorded_ids
+
+
+def get_inventory_progress(inventory_date):
+	"""
+	Remaining and done items of each type during the inventory at **inventory_date**, in a query over its counters
+
+	"""
+	query = (InventoryProgress
+		.select(InventoryProgress.type, InventoryProgress.remaining_count, InventoryProgress.done_count)
+		.join(Inventory)
+		.where(Inventory.date == inventory_date)
+		.order_by(InventoryProgress.type)
+		.namedtuples()
+	)
+	return tuple(query)
 
 
 def get_inventory_items_select_list(date, selected_item_type=""):
@@ -602,9 +1047,10 @@ def get_inventory_items_select_list(date, selected_item_type=""):
 	return query
 
 
-def get_current_inventory_remaining_items(item_type):
+def get_current_inventory_remaining_items(item_type, after=None, limit=None):
 	"""
 	List of the items references of the type **item_type** that still have to be inventoried during the current inventory.
+	The list is paginated by **limit** references following the reference **after** (from the first one if None).
 
 	"""
 	running_inventory_date = get_running_inventory_date()
@@ -612,6 +1058,7 @@ def get_current_inventory_remaining_items(item_type):
 	columns = (Item.reference, )
 	if item_type is None:
 		return TableRequestResult(columns, ())
+	# anti-join backed by the (item_id, date) unique index of the states
 	subq = (ItemState
 		.select()
 		.where(
@@ -621,14 +1068,14 @@ def get_current_inventory_remaining_items(item_type):
 
 	query = (Item
 		.select(Item.id, *columns)
-		.join(ItemState, JOIN.LEFT_OUTER, on=(ItemState.item_id == Item.id))
 		.where(
 			(Item.type == item_type)
 			& (Item.is_trashed == False)
 			& (~fn.EXISTS(subq))
+			& ((Item.reference > after) if after is not None else True)
 		)
 		.order_by(Item.reference)
-		.distinct()
+		.limit(limit)
 		.tuples()
 	)
 	return TableRequestResult(columns, query)
@@ -636,30 +1083,30 @@ def get_current_inventory_remaining_items(item_type):
 
 def get_inventory_missing_items(at_date):
 	query = (Item
-		.select(Item.id)
+		.select(Item.type, Item.reference)
 		.join(ItemState)
 		.where(
 			(ItemState.date == at_date)
 			& (~ItemState.is_present)
 		)
 		.order_by(Item.type, Item.reference)
-		.namedtuples()
+		.tuples()
 	)
-	return tuple([get_item_type_and_reference(row.id) for row in query])
+	return tuple([format_item_name(*row) for row in query])
 
 
 def get_inventory_unusable_items(at_date):
 	query = (Item
-		.select(Item.id)
+		.select(Item.type, Item.reference)
 		.join(ItemState)
 		.where(
 			(ItemState.date == at_date)
 			& (~ItemState.is_usable)
 		)
 		.order_by(Item.type, Item.reference)
-		.namedtuples()
+		.tuples()
 	)
-	return tuple([get_item_type_and_reference(row.id) for row in query])
+	return tuple([format_item_name(*row) for row in query])
 
 
 def get_uninventoried_items(at_date):
@@ -669,13 +1116,11 @@ def get_uninventoried_items(at_date):
 		))
 
 	query = (Item
-		.select(Item.id, Item.type, Item.reference)
-		.join(ItemState, JOIN.LEFT_OUTER)
+		.select(Item.type, Item.reference)
 		.where(
 			(~fn.EXISTS(subq))
 		)
 		.order_by(Item.type, Item.reference)
-		.distinct()
-		.namedtuples()
+		.tuples()
 	)
-	return tuple([get_item_type_and_reference(row.id) for row in query])
+	return tuple([format_item_name(*row) for row in query])
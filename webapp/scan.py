@@ -0,0 +1,81 @@
+#
+# Copyright 2021-2026, Johann Saunier
+# SPDX-License-Identifier: AGPL-3.0-or-later
+#
+import logging
+import re
+
+from webapp import CONFIG_QRCODE, CONFIG_REF_PREFIXES
+
+_LOGGER = logging.getLogger(__name__)
+
+CODE_PATTERN = r"([A-Z]+)([0-9]+)"
+
+
+class ScanDecoder:
+	"""
+	Decode the texts read from the QR codes, the patterns are compiled once for a given configuration
+
+	"""
+
+	def __init__(self, qrcode_config, ref_prefixes):
+		self._item_regex = self._compile(qrcode_config.get('item'), CODE_PATTERN)
+		self._license_regex = self._compile(qrcode_config.get('license'), r"(.+?)")
+		self._code_regex = re.compile(CODE_PATTERN)
+		self._types = {prefix: item_type for item_type, prefix in ref_prefixes.items()}
+
+	@staticmethod
+	def _compile(template, group_pattern):
+		if not template or "%s" not in template:
+			return None
+		return re.compile(group_pattern.join(re.escape(part) for part in template.split("%s", 1)))
+
+	def split_code(self, code):
+		"""
+		Split an item code like 'CG3' into its type and reference, None if the code is malformed
+
+		"""
+		match = self._code_regex.fullmatch(code or "")
+		if not match or match.group(1) not in self._types:
+			return None
+		return (self._types[match.group(1)], match.group(2))
+
+	def decode(self, text):
+		text = (text or "").strip()
+		match = self._item_regex.fullmatch(text) if self._item_regex else None
+		if match:
+			item_type = self._types.get(match.group(1))
+			if item_type is None:
+				_LOGGER.warning("Unknown item prefix in scanned text '%s'", text)
+				return {}
+			_LOGGER.info("Will search for scanned item '%s'", text)
+			return {
+				'item_type': item_type,
+				'item_reference': match.group(2),
+			}
+		match = self._license_regex.fullmatch(text) if self._license_regex else None
+		if match:
+			_LOGGER.info("Will search for scanned license '%s'", text)
+			return {
+				'license_nb': match.group(1),
+			}
+		return {}
+
+
+# the decoder of the configuration, built once at load
+DEFAULT_SCAN_DECODER = ScanDecoder(CONFIG_QRCODE, CONFIG_REF_PREFIXES)
+
+_DECODERS = {}
+
+
+def get_scan_decoder(qrcode_config=None, ref_prefixes=None):
+	if qrcode_config is None and ref_prefixes is None:
+		return DEFAULT_SCAN_DECODER
+	qrcode_config = CONFIG_QRCODE if qrcode_config is None else qrcode_config
+	ref_prefixes = CONFIG_REF_PREFIXES if ref_prefixes is None else ref_prefixes
+	key = (tuple(sorted(dict(qrcode_config).items())), tuple(sorted(dict(ref_prefixes).items())))
+	try:
+		return _DECODERS[key]
+	except KeyError:
+		decoder = _DECODERS[key] = ScanDecoder(qrcode_config, ref_prefixes)
+		return decoder
@@ -0,0 +1,116 @@
+//
+// Copyright 2021-2026, Johann Saunier
+// SPDX-License-Identifier: AGPL-3.0-or-later
+//
+define(['lib', 'qrcodeReader', 'dyn_table'], function(lib, qrcodeReader, dyn_table) {
+
+	const BATCH_DELAY = 2000;
+
+	let pendingTexts = [];
+	let sentTexts = new Set();
+	let batchTimer = null;
+
+	function sendBatch() {
+		batchTimer = null;
+		if (pendingTexts.length == 0) {
+			return;
+		}
+		let data = new FormData();
+		for (let scannedText of pendingTexts) {
+			data.append("scanned_texts", scannedText);
+		}
+		pendingTexts = [];
+		data.append("is_present", document.getElementById("scan-is-present").checked ? "true" : "false");
+		data.append("is_usable", document.getElementById("scan-is-usable").checked ? "true" : "false");
+		console.log("[inventory] sendBatch data:");
+		console.log(data);
+
+		lib.fetchPost("/inventory/scan_batch.json", data, (data) => {
+			console.log("[inventory] sendBatch received data:");
+			console.log(data);
+
+			let popupElt = document.getElementById("inventory-scan-popup");
+			if (data.message) {
+				let lineElt = document.createElement("div");
+				lineElt.innerHTML = data.message;
+				lineElt.classList.add("alert", "alert-danger");
+				popupElt.prepend(lineElt);
+			}
+			for (let result of data.results) {
+				let lineElt = document.createElement(result.url ? "a" : "div");
+				lineElt.innerHTML = result.message;
+				lineElt.classList.add("alert", result.success ? "alert-success" : "alert-danger", "d-block");
+				if (result.url) {
+					lineElt.href = result.url;
+				}
+				popupElt.prepend(lineElt);
+			}
+			popupElt.classList.remove("hidden");
+			popupElt.classList.add("shown");
+		});
+	}
+
+	function onScanned(decodedText) {
+		// the reader decodes a label many times while it is in front of the camera
+		if (sentTexts.has(decodedText)) {
+			return;
+		}
+		console.log(`[inventory] QR Code read: ${decodedText}`);
+		sentTexts.add(decodedText);
+		pendingTexts.push(decodedText);
+		if (batchTimer === null) {
+			batchTimer = setTimeout(sendBatch, BATCH_DELAY);
+		}
+	}
+
+	let firstPageUrl = null;
+
+	function toggle(elt, isShown) {
+		elt.classList.toggle("hidden", !isShown);
+		elt.classList.toggle("shown", isShown);
+	}
+
+	function updatePageButtons(url, isFirstPage) {
+		// the remaining items come by pages of the table, each one gives the url of the next one
+		let nextButton = document.getElementById("remaining-items-next-btn");
+		fetch(url).then((response) => response.json()).then((data) => {
+			nextButton.dataset.url = data.next || "";
+			toggle(nextButton, Boolean(data.next));
+			toggle(document.getElementById("remaining-items-first-btn"), !isFirstPage);
+		});
+	}
+
+	function showRemainingItems(url, isFirstPage = true) {
+		if (isFirstPage) {
+			firstPageUrl = url;
+		}
+		dyn_table.fetchDynTable(url, document.querySelector("table[name='current_remaining_items']"));
+		updatePageButtons(url, isFirstPage);
+	}
+
+	function start() {
+		let nextButton = document.getElementById("remaining-items-next-btn");
+		if (nextButton) {
+			nextButton.addEventListener('click', (event) => showRemainingItems(nextButton.dataset.url, false));
+			document.getElementById("remaining-items-first-btn").addEventListener('click', (event) => showRemainingItems(firstPageUrl));
+			// the first page is loaded by dyn_table with the page
+			firstPageUrl = "/inventory/current_remaining_items.table";
+			updatePageButtons(firstPageUrl, true);
+		}
+		let scanButton = document.getElementById("inventory-scan-btn");
+		if (scanButton) {
+			console.log("[inventory] start");
+			scanButton.addEventListener('click', (event) => {
+				scanButton.classList.add("hidden");
+				qrcodeReader.startQrcodeScan("barcode-reader-field", onScanned);
+			});
+		}
+	}
+
+	return {
+		start: start,
+		sendBatch: sendBatch,
+		showRemainingItems: showRemainingItems,
+	}
+
+});
@@ -56,6 +56,80 @@ define(['lib', 'qrcodeReader'], function(lib, qrcodeReader) {
 		});
 	}
 
+	function sendBatch(scannedTexts, itemsIds) {
+		let data = new FormData(document.querySelector("form"));
+		for (let scannedText of scannedTexts || []) {
+			data.append("scanned_texts", scannedText);
+		}
+		for (let itemId of itemsIds || []) {
+			data.append("items_ids", itemId);
+		}
+		console.log("[loan] sendBatch data:");
+		console.log(data);
+
+		lib.fetchPost(window.location.pathname + "/collect_batch.json", data, (data) => {
+			console.log("[loan] sendBatch received data:");
+			console.log(data);
+
+			let popupElt = document.getElementById("borrow-popup");
+			popupElt.innerHTML = "";
+			popupElt.classList.remove("alert-success");
+			popupElt.classList.remove("alert-danger");
+			if (data.message) {
+				popupElt.innerHTML = data.message;
+				popupElt.classList.add("alert-danger");
+			}
+			for (let result of data.results) {
+				let lineElt = document.createElement("div");
+				lineElt.innerHTML = result.message;
+				lineElt.classList.add("alert", result.success ? "alert-success" : "alert-danger");
+				popupElt.appendChild(lineElt);
+			}
+			popupElt.classList.remove("hidden");
+			popupElt.classList.add("shown");
+
+			setTimeout(() => {
+				popupElt.innerHTML = "";
+				popupElt.classList.remove("shown");
+				popupElt.classList.add("hidden");
+			}, data.timeout * 1000);
+		});
+	}
+
+	let kitTexts = [];
+
+	function addToKit(scannedText) {
+		// the reader decodes a label many times while it is in front of the camera
+		if (kitTexts.includes(scannedText)) {
+			return;
+		}
+		console.log(`[loan] add to the kit: ${scannedText}`);
+		kitTexts.push(scannedText);
+		let lineElt = document.createElement("div");
+		lineElt.textContent = scannedText;
+		document.getElementById("kit-items").appendChild(lineElt);
+		let lendButton = document.getElementById("kit-lend-btn");
+		lendButton.classList.remove("hidden");
+		lendButton.classList.add("shown");
+	}
+
+	function onKitLent(event) {
+		sendBatch(kitTexts);
+		kitTexts = [];
+		document.getElementById("kit-items").innerHTML = "";
+		event.target.classList.remove("shown");
+		event.target.classList.add("hidden");
+	}
+
+	function onScanned(decodedText) {
+		let kitModeElt = document.getElementById("kit-mode");
+		if (kitModeElt && kitModeElt.checked) {
+			addToKit(decodedText);
+		} else {
+			sendForm(decodedText);
+		}
+	}
+
 	function onSubmit(event) {
 		event.preventDefault();
 		sendForm();
@@ -74,7 +148,7 @@ define(['lib', 'qrcodeReader'], function(lib, qrcodeReader) {
 				console.log("Trigger QR code reading...");
 				qrcodeReader.startQrcodeScan("barcode-reader-field", (decodedText) => {
 					console.log(`QR Code read: ${decodedText}`);
-					sendForm(decodedText);
+					onScanned(decodedText);
 				});
 			});
 		}
@@ -89,7 +163,11 @@ define(['lib', 'qrcodeReader'], function(lib, qrcodeReader) {
 			}
 			document.getElementById("degraded-mode-btn").addEventListener('click', onDegradedModeToggled);
 			for (let btn of document.querySelectorAll(".fake-qrcode-btn")) {
-				btn.addEventListener('click', (event) => {sendForm(btn.innerHTML); });
+				btn.addEventListener('click', (event) => {onScanned(btn.innerHTML); });
+			}
+			let lendButton = document.getElementById("kit-lend-btn");
+			if (lendButton) {
+				lendButton.addEventListener('click', onKitLent);
 			}
 		}
 
@@ -98,6 +176,7 @@ define(['lib', 'qrcodeReader'], function(lib, qrcodeReader) {
 	return {
 		start: start,
 		sendForm: sendForm,
+		sendBatch: sendBatch,
 	}
 
 });
@@ -12,12 +12,13 @@ require.config({
 		dyn_table:    "/static/weblib/script/dyn_table",
 		qrcodeReader: "/static/weblib/script/qrcode-reader",
 		qrcode:       "/static/script/qrcode",
-		loan:         "/static/script/loan"
+		loan:         "/static/script/loan",
+		inventory:    "/static/script/inventory"
 	}
 });
 
 
-requirejs(['domReady', 'lib', 'dyn_table', 'loan'], function(domReady, lib, dyn_table, loan) {
+requirejs(['domReady', 'lib', 'dyn_table', 'loan', 'inventory'], function(domReady, lib, dyn_table, loan, inventory) {
 
 	require(['domReady'], function(domReady) {
 		domReady(function () {
@@ -27,13 +28,13 @@ requirejs(['domReady', 'lib', 'dyn_table', 'loan'], function(domReady, lib, dyn_
 
 			// Business logic
 			loan.start();
+			inventory.start();
 
 			const elt = document.getElementsByName("remaining_items")[0];
 			if (elt) {
 				elt.addEventListener('change', (evt) => {
-					const table = document.querySelector("table[name='current_remaining_items']");
 					console.log("evt.target.value=" + evt.target.value);
-					dyn_table.fetchDynTable("/inventory/current_remaining_items.table?item_type=" + evt.target.value, table);
+					inventory.showRemainingItems("/inventory/current_remaining_items.table?item_type=" + evt.target.value);
 				});
 			}
 
@@ -4,25 +4,25 @@
 #
 import logging
 from datetime import datetime
-from os import chdir, getcwd, mkdir, remove, walk
-from os.path import dirname, expanduser, join
-from shutil import copyfile, rmtree
-from tempfile import mkdtemp
-from zipfile import ZipFile
+from os.path import join
+from tempfile import gettempdir
 
-from flask import Blueprint, current_app, redirect, request, send_from_directory, url_for
+from flask import Blueprint, abort, current_app, jsonify, redirect, request, url_for
 from flask_babel import gettext as _
 from flask_babel import lazy_gettext as _l
 from flask_login import login_required
-from weblib.models import WEBLIB_MODELS
 from weblib.roles import ROLE_USER, roles_required
-from weblib.utils import Shell, mkstemp
 
 from webapp import CONFIG_QRCODE, CONFIG_REF_PREFIXES
-from webapp.forms import BaseForm, TextField, UploadDBForm, UploadMembersForm
-from webapp.models import MODELS, Item
-from webapp.qrcode_gen import generate_qrcodes
-from webapp.requests import get_item_references, get_servicing_files
+from webapp.archive import zip_response
+from webapp.backup import backup_db
+from webapp.cache import get_process_caches_stats
+from webapp.forms import (
+	BaseForm, SelectField, TextField, UploadBackupsChainForm, UploadDBForm, UploadMembersForm, restore_backups_action
+)
+from webapp.models import Item
+from webapp.qrcode_gen import OUTPUT_FORMATS, TileCache, generate_qrcode_pages
+from webapp.requests import get_item_references
 from webapp.views.main import site
 
 _LOGGER = logging.getLogger(__name__)
@@ -43,39 +43,27 @@ def admin():
 	return redirect(url_for(".admin_tools"))
 
 
+@admin_views.route('/admin/caches.json', methods=['GET'])
+def admin_caches_json():
+	return jsonify(get_process_caches_stats())
+
+
 @admin_views.route('/admin/tools', methods=['GET'])
 def admin_tools():
 	form_db_restore = UploadDBForm()
+	form_db_restore_chain = UploadBackupsChainForm()
+	form_db_restore_chain.zipfiles.render_kw = {'multiple': True, 'accept': ".zip"}  # FIXME handle this in my forms
 	form_members_import = UploadMembersForm()
 	return site.render_page(
 		form_db_restore=form_db_restore,
+		form_db_restore_chain=form_db_restore_chain,
 		form_members_import=form_members_import,
 	)
 
 
-def zipdir(dirpath, zip_filename):
-	_LOGGER.info("Building a zip file '%s' from '%s''s content", zip_filename, dirpath)
-	from_dir = getcwd()
-	try:
-		chdir(dirpath)
-		filepaths = []
-		for dir_path, _, filenames in walk("."):
-			for filename in filenames:
-				filepaths.append(join(dir_path, filename))
-		with ZipFile(zip_filename, 'w') as zipobj:
-			for filepath in filepaths:
-				_LOGGER.debug("Adding '%s'", filepath)
-				zipobj.write(filepath)
-	except:
-		_LOGGER.exception("Zip failed")
-	finally:
-		chdir(from_dir)
-
-	return dirpath, zip_filename
-
-
 class QRCodeListForm(BaseForm):  # FIXME translation
 	fields = dict([(item_type, TextField("%s (%s)" % (_l(Item.type.lut[item_type]), prefix))) for item_type, prefix in CONFIG_REF_PREFIXES.items()])
+	fields['format'] = SelectField(_l("Output format"), choices=[(output_format, output_format.upper()) for output_format in OUTPUT_FORMATS], default="png")
 
 
 @admin_views.route('/admin/qrcode', methods=['GET'])
@@ -95,19 +83,25 @@ def admin_qrcode():
 	)
 
 
-def _admin_qrcode_generate(references):
-	_LOGGER.info("Generating QR codes...")
-	tmpdir = mkdtemp()
+def get_qrcode_cache():
+	cache_dir = CONFIG_QRCODE.get('cache_dir') or join(gettempdir(), "jellyfish-qrcodes")
+	cache_size = int(CONFIG_QRCODE.get('cache_size', 100))
+	return TileCache(cache_dir, max_bytes=cache_size * 1024 * 1024)
 
-	try:
-		qr_list = [(CONFIG_QRCODE['item'] % ref, ref) for ref in references]
-		generate_qrcodes(tmpdir, "page", qr_list)
-		return send_from_directory(*zipdir(tmpdir, "QRcodes.zip"), as_attachment=True)
-	finally:
-		_LOGGER.info("Cleanup temp dir '%s'", tmpdir)
-		rmtree(tmpdir)
 
-	return redirect(url_for(".admin_qrcode"))
+def _admin_qrcode_generate(references):
+	_LOGGER.info("Generating QR codes...")
+	output_format = request.values.get('format', "png")
+	# checked before streaming: an error inside the archive would come after the status line and truncate it
+	if output_format not in OUTPUT_FORMATS:
+		_LOGGER.warning("Invalid QR codes output format '%s'", output_format)
+		abort(400, "'%s' is not a valid output format" % output_format)
+	qr_list = [(CONFIG_QRCODE['item'] % ref, ref) for ref in references]
+	pages = generate_qrcode_pages(qr_list, cache=get_qrcode_cache(), output_format=output_format)
+	return zip_response(
+		(("page%d.%s" % (page_nb, output_format), page.to_bytes()) for page_nb, page in enumerate(pages, start=1)),
+		"QRcodes.zip",
+	)
 
 
 def _cat(data_txt, data_int):
@@ -150,71 +144,17 @@ def _admin_qrcode_generate_from_list():
 	return _admin_qrcode_generate(references)
 
 
-def backup_db(destdir):
-	db_name = current_app.config['DATABASE']['name']
-	sh = Shell()
-
-	_LOGGER.info("Creating an SQL backup of the database in '%s'", destdir)
-	sql_filepath = "%s.sql" % join(destdir, db_name)
-	cmd = "pg_dump --no-owner %s" % db_name
-	_LOGGER.debug("Executing command '%s'", cmd)
-	sh.execute(cmd, split_stdout_stderr=True)
-	if sh.retcode == 0:
-		try:
-			with open(sql_filepath, 'w') as fobj:
-				fobj.write("\n".join(sh.stdout))
-		except UnicodeEncodeError:
-			_LOGGER.exception("Ooops")
-	else:
-		_LOGGER.error("SQL backup failed : %s", sh.stderr)
-		_LOGGER.error("SQL backup failed : %s", sh.stdout)
-
-	_LOGGER.info("Creating a CSV backup of the database in '%s'", destdir)
-	try:
-		sql_cmd_file = mkstemp()
-		destdir_csv = join(destdir, "csv")
-		mkdir(destdir_csv)
-		with open(sql_cmd_file, 'w') as fobj:
-			for table_name in [m._meta.table_name.lower() for m in MODELS + WEBLIB_MODELS]:
-				fobj.write(f"\\copy (SELECT * FROM \"{table_name}\" ORDER BY id) to '{destdir_csv}/{table_name}.csv' csv HEADER DELIMITER ';'\n")
-		cmd = "psql %s -f %s" % (db_name, sql_cmd_file)
-		_LOGGER.debug("Executing command '%s'", cmd)
-		sh.execute(cmd, capture=False)
-		if sh.retcode:
-			_LOGGER.error("CSV backup failed")
-	finally:
-		remove(sql_cmd_file)
-	try:
-		mkdir(join(destdir, "servicings"))
-	except Exception:
-		_LOGGER.exception("Could not backup servicing files")
-		return
-	for hashed_filename, exported_filename in get_servicing_files():
-		try:
-			src = expanduser(f"~/{hashed_filename}")
-			dst = join(destdir, "servicings", exported_filename)
-			_LOGGER.debug("Copying file '%s' to '%s'", src, dst)
-			copyfile(src, dst)
-		except FileNotFoundError:
-			_LOGGER.error("'%s' referenced in DB but not found on filesystem !", src)
-		except Exception:
-			_LOGGER.exception("Could not backup servicing files")
-
-
 @admin_views.route('/admin/tools/db/backup', methods=['GET'])
 def admin_tools_db_backup():
-	_LOGGER.info("Backup DB...")
-	tmpdir = mkdtemp()
-	try:
-		copyfile(join(dirname(dirname(__file__)), "..", "config.ini"), join(tmpdir, "config.ini"))
-		backup_db(tmpdir)
-		timestamp = datetime.strftime(datetime.now(), "%Y-%m-%dT%H-%M")
-		return send_from_directory(*zipdir(tmpdir, "Jellyfish_%s.zip" % timestamp), as_attachment=True)
-	except:
-		_LOGGER.exception("DB backup failed")
-	finally:
-		_LOGGER.info("Cleanup temp dir '%s'", tmpdir)
-		rmtree(tmpdir)
+	incremental = request.args.get('incremental') == "1"
+	_LOGGER.info("Backup DB (incremental=%s)...", incremental)
+	timestamp = datetime.strftime(datetime.now(), "%Y-%m-%dT%H-%M")
+	entries, record_manifest = backup_db(current_app.config['DATABASE']['name'], incremental=incremental)
+	return zip_response(
+		entries,
+		"Jellyfish_%s%s.zip" % (timestamp, "_incremental" if incremental else ""),
+		on_complete=record_manifest,
+	)
 
 
 @admin_views.route('/admin/tools/db/restore', methods=['POST'])
@@ -225,6 +165,16 @@ def admin_tools_db_restore():
 	return redirect(url_for('.admin_tools'))
 
 
+@admin_views.route('/admin/tools/db/restore_chain', methods=['POST'])
+def admin_tools_db_restore_chain():
+	form = UploadBackupsChainForm()
+	archives = request.files.getlist('zipfiles')
+	_LOGGER.info("Restoring DB from a chain of %d backups...", len(archives))
+	if form.validate() and archives:
+		restore_backups_action([archive.stream for archive in archives])
+	return redirect(url_for('.admin_tools'))
+
+
 @admin_views.route('/admin/tools/member/import', methods=['POST'])
 def admin_tools_member_import():
 	_LOGGER.info("Importing members...")
@@ -29,8 +29,8 @@ from webapp.items import (
 )
 from webapp.models import Item, ItemState, Servicing
 from webapp.requests import (
-	DatabaseException, create_item, create_item_servicing, create_item_state, get_item, get_item_type,
-	get_item_type_and_reference, get_items, get_regulators, get_running_inventory_date, trash_item, untrash_item
+	create_item, create_item_servicing, create_item_state, get_item, get_item_type, get_item_type_and_reference,
+	get_items, get_regulators, get_running_inventory_date, refresh_item_states, trash_item, untrash_item, update_item
 )
 from webapp.tables import ITEMS_COLUMNS
 
@@ -168,7 +168,7 @@ def item_info(item_id=None, table_name=None, crud_step="read", filename=None):
 	group, item_type = get_group_and_type(item_id)
 	if filename is not None:
 		return send_from_directory(environ.get('UPLOAD_DIR', environ['HOME']), filename)  #, as_attachment=True)
-	return crud_page(table_name, crud_step,
+	response = crud_page(table_name, crud_step,
 		html_template="gear/item/info.html",
 		item_name=Item.type.lut[get_item_type(item_id)],
 		reference=get_item(item_id)['reference'],
@@ -198,6 +198,9 @@ def item_info(item_id=None, table_name=None, crud_step="read", filename=None):
 			},
 		},
 	)
+	if table_name == 'state' and crud_step != "read":
+		refresh_item_states(item_id)
+	return response
 
 
 @gear_views.route('/gear/item/delete')
@@ -251,9 +254,7 @@ def item_modify():
 			fd = copy(form.dict)
 			fd.pop('type')
 			_LOGGER.info("Modifying item '%s'", fd)
-			query = Item.update(fd).where(Item.id == item_id)
-			if query.execute() != 1:
-				raise DatabaseException("Could not update item '%s'" % item_id)
+			update_item(item_id, **fd)
 			return redirect('/gear/%s/%s' % get_group_and_type(item_id))
 		else:
 			_LOGGER.info("Displaying errors for item '%s'", item_id)
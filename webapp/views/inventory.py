@@ -16,12 +16,15 @@ from weblib.views import site
 from webapp.forms import InventorySelectForm
 from webapp.models import Item
 from webapp.requests import (
-	create_inventory, get_current_inventory_remaining_items, get_inventories, get_inventory, get_inventory_date,
-	get_inventory_items_select_list, get_inventory_missing_items, get_inventory_unusable_items, get_items_count_table,
-	get_items_estimations, get_items_estimations_table, get_latest_inventory_date, get_running_inventory_date,
-	get_uninventoried_items, restart_inventory_campaign, stop_inventory_campaign
+	carry_forward_states, create_inventory, create_items_states, format_item_name,
+	get_current_inventory_remaining_items, get_inventories, get_inventory, get_inventory_date,
+	get_inventory_items_select_list, get_inventory_missing_items, get_inventory_progress, get_inventory_unusable_items,
+	get_items_count_table, get_items_estimations, get_items_estimations_table, get_items_names,
+	get_latest_inventory_date, get_running_inventory_date, get_uninventoried_items, restart_inventory_campaign,
+	stop_inventory_campaign
 )
 from webapp.roles import ROLE_LENDER
+from webapp.scan import get_scan_decoder
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -57,19 +60,34 @@ def inventory_tab():
 		_LOGGER.info("Asked to stop the inventory")
 		assert running_inventory_date is not None
 		stop_inventory_campaign()
+	elif request.args.get('carry_forward'):
+		item_type = request.args.get('carry_forward')
+		_LOGGER.info("Asked to apply the previous inventory to the remaining '%s'", item_type)
+		carry_forward_states(None if item_type == "all" else item_type)
+		return redirect(url_for(".inventory_tab"))
 	elif request.args.get('select'):
 		item_type = request.args.get('select')
 		_LOGGER.info(f"Select box modified. Chosen item is '{item_type}'")
 		session_inventory['current_item_type'] = item_type
 
 	form = InventorySelectForm()
-	form.remaining_items.choices = [(row[0], "%s (%s)" % (Item.type.lut[row[0]], row[1])) for row in get_inventory_items_select_list(running_inventory_date, session_inventory.get('current_item_type', ""))]
-
-	if not session_inventory.get('current_item_type'):
+	if running_inventory_date is not None:
+		# the selected type first, then by type
+		remaining_counts = [(row.type, row.remaining_count) for row in get_inventory_progress(running_inventory_date) if row.remaining_count]
+		remaining_counts.sort(key=lambda row: row[0] != session_inventory.get('current_item_type', ""))
+	else:
+		remaining_counts = [(row[0], row[1]) for row in get_inventory_items_select_list(running_inventory_date, session_inventory.get('current_item_type', ""))]
+	form.remaining_items.choices = [(item_type, "%s (%s)" % (Item.type.lut[item_type], count)) for item_type, count in remaining_counts]
+
+	if not form.remaining_items.choices:
+		_LOGGER.info("No more items to process during this inventory")
+		session_inventory['current_item_type'] = ""
+		session.modified = True
+	elif not session_inventory.get('current_item_type'):
 		_LOGGER.info("No item selected yet -> autoselect the first of the list")
 		session_inventory['current_item_type'] = form.remaining_items.choices[0][0]
 		session.modified = True
-	elif not [r for r in get_current_inventory_remaining_items(session_inventory['current_item_type']).query]:
+	elif session_inventory['current_item_type'] not in dict(remaining_counts):
 		_LOGGER.info("No more '%s' to process during this inventory -> go to the next ones", session_inventory['current_item_type'])
 		session_inventory['current_item_type'] = form.remaining_items.choices[0][0]
 		session.modified = True
@@ -81,10 +99,86 @@ def inventory_tab():
 		has_been_started_today=get_inventory(today) is not None,
 		is_in_progress=bool(running_inventory_date),
 		running_inventory_date=get_running_inventory_date(),
+		current_item_type=session_inventory['current_item_type'],
 		form=form,
 	)
 
 
+@inventory_views.route('/inventory/scan_batch.json', methods=['POST'])
+@roles_required(ROLE_USER, ROLE_LENDER)
+def inventory_scan_batch_json():
+	"""
+	Scan mode: the scanned items are recorded with the same present and usable flags, in one transaction. There is
+	one reply for each scanned text, the items which need more than these flags are set from the full state form
+
+	"""
+	INVENTORY_NOT_RUNNING = _("No inventory campaign is running")
+	INVENTORY_INVALID_SCANNED_TEXT = _("Scanned text is invalid")
+	INVENTORY_UNKNOWN_ITEM = _("Unknown item")
+	INVENTORY_ALREADY_INVENTORIED = _("%s has already been inventoried")
+	INVENTORY_ITEM_INVENTORIED = _("%s inventoried")
+
+	running_inventory_date = get_running_inventory_date()
+	if running_inventory_date is None:
+		return jsonify({'success': False, 'message': INVENTORY_NOT_RUNNING, 'results': []})
+	is_present = request.form.get('is_present', "true") == "true"
+	is_usable = request.form.get('is_usable', "true") == "true"
+
+	decoder = get_scan_decoder()
+	lines = []
+	for scanned_text in request.form.getlist('scanned_texts'):
+		scanned_code = decoder.decode(scanned_text)
+		if scanned_code.get('item_type') is not None and scanned_code.get('item_reference'):
+			lines.append((scanned_code['item_type'], int(scanned_code['item_reference'])))
+		else:
+			lines.append(None)
+	items_names = get_items_names(types_references=[line for line in lines if line is not None])
+	items_ids = {(item_type, reference): item_id for item_id, (item_type, reference) in items_names.items()}
+
+	_LOGGER.info("Inventory of the scanned items %s (is_present=%s, is_usable=%s)", list(items_ids), is_present, is_usable)
+	recorded_ids = set(create_items_states(list(items_ids.values()), running_inventory_date, is_present, is_usable))
+
+	results = []
+	for line in lines:
+		item_id = items_ids.get(line)
+		if line is None:
+			results.append({'success': False, 'message': INVENTORY_INVALID_SCANNED_TEXT})
+		elif item_id is None:
+			results.append({'success': False, 'message': INVENTORY_UNKNOWN_ITEM})
+		elif item_id in recorded_ids:
+			recorded_ids.remove(item_id)  # a label scanned twice is recorded once
+			results.append({'success': True, 'message': INVENTORY_ITEM_INVENTORIED % format_item_name(*line)})
+		else:
+			results.append({
+				'success': False,
+				'message': INVENTORY_ALREADY_INVENTORIED % format_item_name(*line),
+				'url': "/gear/item/info/%s" % item_id,
+			})
+	return jsonify({'success': True, 'message': "", 'results': results})
+
+
+@inventory_views.route('/inventory/progress.json')
+@roles_required(ROLE_USER, ROLE_LENDER)
+def inventory_progress_json():
+	running_inventory_date = get_running_inventory_date()
+	if running_inventory_date is None:
+		return jsonify(None)
+	return jsonify({
+		'date': running_inventory_date.isoformat(),
+		'types': [
+			{
+				'type': row.type,
+				'name': str(Item.type.lut[row.type]),
+				'remaining': row.remaining_count,
+				'done': row.done_count,
+			}
+			for row in get_inventory_progress(running_inventory_date)
+		],
+	})
+
+
+REMAINING_ITEMS_PAGE_SIZE = 200
+
 @inventory_views.route('/inventory/current_remaining_items.table')
 @roles_required(ROLE_USER, ROLE_LENDER)
 def inventory_current_items_table():
@@ -94,10 +188,18 @@ def inventory_current_items_table():
 	if current_item_type is not None:
 		session['prev_url'] = url_for(".inventory_tab") + "?select=" + current_item_type
 	session.modified = True
+	after = request.args.get('after', type=int)
+	limit = request.args.get('limit', REMAINING_ITEMS_PAGE_SIZE, type=int)
+	remaining_items = get_current_inventory_remaining_items(current_item_type, after=after, limit=limit)
 	table = Table("current_remaining_items")
-	table.build_from_request(get_current_inventory_remaining_items(current_item_type))
+	table.build_from_request(remaining_items)
 	table.action = {'href': "/gear/item/add_state"}
-	return jsonify(table.dict)
+	table_dict = table.dict
+	rows = list(remaining_items.query)
+	if len(rows) == limit:
+		# keyset pagination: the next page starts after the last reference of this one
+		table_dict['next'] = url_for(".inventory_current_items_table", item_type=current_item_type, after=rows[-1][1], limit=limit)
+	return jsonify(table_dict)
 
 
 @inventory_views.route('/inventory/inventories.table')
@@ -3,7 +3,6 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 #
 import logging
-import re
 from datetime import datetime
 from urllib.parse import urlparse
 
@@ -20,10 +19,12 @@ from webapp.forms import CollectionFormManual, CollectionFormScan, Reintegration
 from webapp.items import GEAR
 from webapp.models import Item
 from webapp.requests import (
-	borrow_item, get_borrowed_items, get_item, get_item_id, get_item_references, get_item_type, get_member, get_member_id,
-	get_members_fullnames, get_type_and_id, give_back_item
+	DatabaseException, borrow_item, borrow_items, get_available_item_references, get_borrowed_items, get_item,
+	get_item_id, get_item_type, get_items_names, get_member, get_member_id, get_members_fullnames, get_type_and_id,
+	give_back_item
 )
 from webapp.roles import ROLE_LENDER
+from webapp.scan import get_scan_decoder
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -43,30 +44,7 @@ def loan_tab():
 
 
 def get_scanned_code_content(text, config_dict=None):
-	config_dict = config_dict or CONFIG_QRCODE
-	item_start = config_dict['item'].replace(r"%s", r"")
-	if text.startswith(item_start):
-		_LOGGER.info("Will search for scanned item '%s'", text)
-		item_template = config_dict['item'].replace(r"%s", r"([A-Z]*)([0-9]*)")
-		match = re.search(item_template, text)
-		item_type, item_reference = match.group(1), match.group(2)
-		item_type = [k for k, v in CONFIG_REF_PREFIXES.items() if item_type == v][0]
-		return {
-			'item_type': item_type,
-			'item_reference': item_reference,
-		}
-	elif text.startswith(config_dict['license'].split('=')[0]):
-		_LOGGER.info("Will search for scanned license '%s'", text)
-		license_template = config_dict['license'].replace(r"%s", r"(.*)")
-		try:
-			license_nb = re.search(license_template.split('=')[1], text.split('=')[1]).group(1)
-		except:
-			_LOGGER.exception("Could not extract license")
-		return {
-			'license_nb': license_nb,
-		}
-	else:
-		return {}
+	return get_scan_decoder(config_dict).decode(text)
 
 
 @loan_views.route('/loan/collection/collect.json', methods=['POST'])
@@ -107,9 +85,12 @@ def loan_collection_json():
 			item_type = scanned_code.get('item_type')
 			item_reference = scanned_code.get('item_reference')
 			item_id = get_item_id(item_type, item_reference)
+			if item_id is None:
+				_LOGGER.warning("Scanned item '%s %s' is unknown or trashed", item_type, item_reference)
+				return reply(False, LOAN_INVALID_SCANNED_TEXT)
 			item_name = Item.type.lut[item_type]
-		elif scanned_code.get('license') is not None:
-			return jsonify(get_member_id(scanned_code.get('license')))
+		elif scanned_code.get('license_nb') is not None:
+			return jsonify(get_member_id(scanned_code.get('license_nb')))
 		else:
 			return reply(False, LOAN_INVALID_SCANNED_TEXT)
 	else:
@@ -134,14 +115,104 @@ def loan_collection_json():
 	except peewee.IntegrityError:
 		_LOGGER.exception("Already borrowed exception")
 		return reply(False, LOAN_ALREADY_BORROWED % ("%s %s" % (item_name, item_reference)))
+	except DatabaseException:
+		_LOGGER.exception("Could not lend item")
+		return reply(False, LOAN_INVALID_DATA)
 
 	return reply(True, LOAN_ITEM_BORROWED % ("%s %s" % (item_name, item_reference), member_name))
 
 
+@loan_views.route('/loan/collection/collect_batch.json', methods=['POST'])
+@roles_required(ROLE_LENDER)
+def loan_collection_batch_json():
+	"""
+	Lend a whole kit to a member: the scanned texts and the items ids of the request are resolved with one query
+	and borrowed in one transaction. There is one reply for each given line
+
+	"""
+	LOAN_INVALID_SCANNED_TEXT = _("Scanned text is invalid")
+	LOAN_INVALID_DATA = _("Invalid data")
+	LOAN_ALREADY_BORROWED = _("%s has already been borrowed")
+	LOAN_ITEM_BORROWED = _("%s borrowed by %s")
+
+	form = (CollectionFormScan if session['use_scanner'] else CollectionFormManual)()
+	timeout = float(CONFIG_QRCODE['popup_timeout'])
+
+	def reply(is_success, message):
+		return {'success': is_success, 'message': message}
+
+	if "None" in (form.member.data, form.reason.data):
+		return jsonify({'success': False, 'message': LOAN_INVALID_DATA, 'results': [], 'timeout': timeout})
+	else:
+		session['loan_form'] = {
+			'reason': form.reason.data,
+			'member': form.member.data,
+		}
+		session.modified = True
+
+	member_id = form.member.data
+	usage_counter = int(form.reason.data)
+
+	lines = []
+	for scanned_text in request.form.getlist('scanned_texts'):
+		scanned_code = get_scanned_code_content(scanned_text)
+		if scanned_code.get('item_type') is not None and scanned_code.get('item_reference'):
+			lines.append((scanned_code['item_type'], int(scanned_code['item_reference'])))
+		else:
+			lines.append(None)
+	for item_id in request.form.getlist('items_ids'):
+		lines.append(int(item_id) if item_id.isdigit() else None)
+
+	items_names = get_items_names(
+		items_ids=[line for line in lines if isinstance(line, int)],
+		types_references=[line for line in lines if isinstance(line, tuple)],
+	)
+	items_ids = {(item_type, reference): item_id for item_id, (item_type, reference) in items_names.items()}
+	lines = [items_ids.get(line) if isinstance(line, tuple) else line for line in lines]
+
+	try:
+		member = get_member(member_id)
+	except peewee.DoesNotExist:
+		_LOGGER.warning("Member '%s' does not exist", member_id)
+		return jsonify({'success': False, 'message': LOAN_INVALID_DATA, 'results': [], 'timeout': timeout})
+	member_name = " ".join((member['first_name'], member['last_name']))
+	items_to_borrow = [item_id for item_id in lines if item_id in items_names]
+	_LOGGER.info("User '%s' is lending items %s to member '%s' for '%s' usage(s)",
+		current_user,
+		["%s %s" % items_names[item_id] for item_id in items_to_borrow],
+		member_name,
+		usage_counter,
+	)
+	# one error for each item to borrow, in the order of the lines
+	errors = iter(borrow_items(items_to_borrow, current_user, member_id, datetime.now(), usage_counter))
+
+	results = []
+	for item_id in lines:
+		if item_id not in items_names:
+			results.append(reply(False, LOAN_INVALID_SCANNED_TEXT))
+			continue
+		error = next(errors)
+		item_type, item_reference = items_names[item_id]
+		item_name = "%s %s" % (Item.type.lut[item_type], item_reference)
+		if error is None:
+			results.append(reply(True, LOAN_ITEM_BORROWED % (item_name, member_name)))
+		elif isinstance(error, peewee.IntegrityError):
+			results.append(reply(False, LOAN_ALREADY_BORROWED % item_name))
+		else:
+			_LOGGER.error("Could not lend item '%s': %s", item_name, error)
+			results.append(reply(False, LOAN_INVALID_DATA))
+
+	return jsonify({
+		'success': all(result['success'] for result in results),
+		'results': results,
+		'timeout': timeout,
+	})
+
+
 @loan_views.route('/loan/collection.choices')
 @roles_required(ROLE_LENDER)
 def loan_collection_choices():
-	return jsonify([(item_id, ref) for item_id, ref in get_item_references(request.args.get('get_children'), available_items_only=True)])
+	return jsonify([(item_id, ref) for item_id, ref in get_available_item_references(request.args.get('get_children'))])
 
 
 @loan_views.route('/loan/collection', methods=['GET'])
@@ -191,7 +262,11 @@ def loan_reintegration_tab():
 	if request.method == 'GET':
 		if request.args.get('scanned_gear'):
 			scanned_gear = request.args.get('scanned_gear')
-			give_back_item(get_type_and_id(scanned_gear)[1], now)
+			item_type_and_id = get_type_and_id(scanned_gear)
+			if item_type_and_id is None:
+				_LOGGER.warning("Could not find scanned gear '%s'", scanned_gear)
+			else:
+				give_back_item(item_type_and_id[1], now)
 			return redirect(url_for(".loan_reintegration_tab"))
 		else:
 			if not form.item.choices:
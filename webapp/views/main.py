@@ -16,7 +16,7 @@ from weblib.views import Tab, site
 from webapp.forms import ServicingForm
 from webapp.requests import (
 	create_servicing, get_every_loans, get_items_in_servicing, get_items_to_service, get_loans, get_members_fullnames,
-	unservice
+	listen_to_changes, unservice
 )
 
 _LOGGER = logging.getLogger(__name__)
@@ -31,6 +31,11 @@ def before_request():
 	pass
 
 
+@main_views.before_app_request
+def start_listeners():
+	listen_to_changes()
+
+
 TABS = {
 	'overview': Tab('overview', _l("Overview")),
 	'gear': Tab('gear', _l("Gear")),